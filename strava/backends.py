@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""Code to run the database on MySQL or on an embedded engine.
+
+This module contains the differences between the storage backends. `mysql`
+is the MySQL server the project was written for, while `sqlite` and `duckdb`
+store the database in a single local file, so the schema, the ingest and the
+queries can run without a server. The MySQL statements of `tables` are
+translated to the embedded engines by `translate_ddl`, and the queries build
+their date arithmetic with the dialect helpers `year`, `month`,
+`days_between` and `seconds_between`.
+
+DuckDB is an optional dependency, used through the `duckdb-engine`
+sqlalchemy dialect.
+
+The engine of a backend is created once by `main.py`, and its connection
+pool is shared by the setup, the ingest and the queries.
+
+"""
+import re
+from functools import partial
+
+from pymysql import err as pymysql_err
+from pymysql.constants import ER
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine import URL
+
+# Backends that can store the database
+BACKENDS = ("mysql", "sqlite", "duckdb")
+
+# File name suffixes of the embedded databases
+SUFFIXES = {"sqlite": ".sqlite", "duckdb": ".duckdb"}
+
+# Default number of pooled MySQL connections
+POOL_SIZE = 5
+# Default number of seconds after which a pooled MySQL connection is replaced
+POOL_RECYCLE = 3600
+
+
+def database_path(backend, DB_NAME, path=None):
+    """Get the file of an embedded database.
+
+    Parameters
+    ----------
+    backend : str
+        One of the embedded `BACKENDS`.
+    DB_NAME : str
+        The database name (`TDT4225ProjectGroup78`).
+    path : str, optional
+        The file of the database. Defaults to `DB_NAME` with the suffix of the
+        backend, in the current directory.
+
+    Returns
+    -------
+    path : str
+        The file of the database.
+    """
+    return path if path is not None else f"{DB_NAME}{SUFFIXES[backend]}"
+
+
+def get_engine(
+    backend,
+    user,
+    password,
+    DB_NAME,
+    path=None,
+    pool_size=POOL_SIZE,
+    pool_recycle=POOL_RECYCLE,
+    **options,
+):
+    """Create the sqlalchemy engine of a backend.
+
+    The MySQL engine keeps a pool of `pool_size` connections, which are
+    checked with a ping before they are handed out, so connections dropped
+    by the server are replaced instead of failing the stage that takes them.
+    The credentials are passed as fields of the URL rather than formatted
+    into it, so the password is masked wherever the engine or URL is printed.
+    The URL has no database, since `database.setup_database` may have to
+    create it: every new connection selects `DB_NAME` once it exists.
+
+    PyMySQL interpolates the parameters on the client, and has no
+    server-side prepared statements. The statements are compiled once and
+    reused from the compiled cache of sqlalchemy instead.
+
+    Parameters
+    ----------
+    backend : str
+        One of `BACKENDS`.
+    user : str
+        The entered MySQL user. Not used by the embedded backends.
+    password : str
+        The entered MySQL password. Not used by the embedded backends.
+    DB_NAME : str
+        The database name (`TDT4225ProjectGroup78`).
+    path : str, optional
+        The file of an embedded database, see `database_path`.
+    pool_size : int, optional
+        The number of pooled MySQL connections. Stages that need a connection
+        while all of them are in use wait for one. Defaults to `POOL_SIZE`.
+    pool_recycle : int, optional
+        The number of seconds after which a pooled MySQL connection is
+        replaced. Defaults to `POOL_RECYCLE`.
+    **options
+        The options of `create_engine`, such as `connect_args`. The pool and
+        connect options are only used with MySQL.
+
+    Returns
+    -------
+    sql_engine : :obj:
+        The sqlalchemy engine.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend == "mysql":
+        url = URL.create(
+            "mysql+pymysql", username=user, password=password, host="localhost"
+        )
+        sql_engine = create_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=0,
+            pool_recycle=pool_recycle,
+            pool_pre_ping=True,
+            **options,
+        )
+        event.listen(sql_engine, "connect", partial(_use_database, DB_NAME))
+        return sql_engine
+
+    if backend == "duckdb":
+        try:
+            import duckdb_engine  # noqa: F401
+        except ImportError as err:
+            raise ImportError(
+                "The duckdb backend needs the duckdb and duckdb-engine packages."
+            ) from err
+        return create_engine(f"duckdb:///{database_path(backend, DB_NAME, path)}")
+
+    # SQLite only enforces foreign keys, and so cascades the deletes of an
+    # incremental insert, when asked to on every connection
+    sql_engine = create_engine(
+        f"sqlite:///{database_path(backend, DB_NAME, path)}",
+        connect_args={"check_same_thread": False},
+    )
+    event.listen(sql_engine, "connect", _enable_foreign_keys)
+    return sql_engine
+
+
+def _use_database(DB_NAME, dbapi_cnx, connection_record):
+    """Helper function to select the database of a new MySQL connection.
+
+    Parameters
+    ----------
+    DB_NAME : str
+        The database name (`TDT4225ProjectGroup78`).
+    dbapi_cnx : :obj:
+        The DBAPI (pymysql) connection object.
+    connection_record : :obj:
+        The connection record of the pool.
+
+    """
+    cursor = dbapi_cnx.cursor()
+    try:
+        cursor.execute(f"USE `{DB_NAME}`")
+    except pymysql_err.OperationalError as err:
+        # The database is created later by `database.setup_database`
+        if err.args[0] != ER.BAD_DB_ERROR:
+            raise
+    finally:
+        cursor.close()
+
+
+def _enable_foreign_keys(dbapi_cnx, connection_record):
+    """Helper function to enable the foreign keys of a SQLite connection.
+
+    Parameters
+    ----------
+    dbapi_cnx : :obj:
+        The DBAPI (sqlite3) connection object.
+    connection_record : :obj:
+        The connection record of the pool.
+
+    """
+    cursor = dbapi_cnx.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
+
+
+def translate_ddl(statement, backend):
+    """Translate a MySQL statement of `tables` to a backend.
+
+    The table options and partitioning are dropped, identifiers are quoted
+    with double quotes, and types missing from the backend are widened.
+    DuckDB does not support cascading foreign keys, so they are dropped.
+    Foreign keys can not be added to an existing table of an embedded
+    database, so those statements are skipped. The embedded backends have no
+    spatial types, so the `location` column and its spatial index are
+    dropped, and the lookups of `queries` scan `lat` and `lon` instead.
+
+    Parameters
+    ----------
+    statement : str
+        The MySQL statement.
+    backend : str
+        One of `BACKENDS`.
+
+    Returns
+    -------
+    statement : str
+        The statement for the backend, or None if the backend has no
+        equivalent.
+    """
+    if backend == "mysql":
+        return statement
+    if statement.startswith(("ALTER TABLE", "CREATE SPATIAL INDEX")):
+        return None
+
+    statement = re.sub(r"\s*PARTITION BY .*$", "", statement, flags=re.DOTALL)
+    statement = statement.replace(" ENGINE=InnoDB", "")
+    statement = re.sub(r"\s*`location` POINT .*? SRID 4326,", "", statement)
+    statement = re.sub(r"\s*SPATIAL INDEX `\w+` \(`location`\),", "", statement)
+    statement = statement.replace("`", '"')
+    statement = re.sub(r"\bMEDIUMINT\b", "INTEGER", statement)
+    statement = re.sub(r"^CREATE (TABLE|INDEX) ", r"CREATE \1 IF NOT EXISTS ", statement)
+    if backend == "duckdb":
+        statement = statement.replace("DATETIME", "TIMESTAMP")
+        statement = re.sub(
+            r",\s*CONSTRAINT \"\w+\" FOREIGN KEY .*?ON DELETE CASCADE", "", statement
+        )
+    return statement
+
+
+def year(dialect, expr):
+    """Get the SQL of the year of a datetime.
+
+    Parameters
+    ----------
+    dialect : str
+        The name of the sqlalchemy dialect of the connection.
+    expr : str
+        The SQL of the datetime.
+
+    Returns
+    -------
+    sql : str
+        The SQL of the year, as an integer.
+    """
+    if dialect == "sqlite":
+        return f"CAST(strftime('%Y', {expr}) AS INTEGER)"
+    return f"YEAR({expr})"
+
+
+def month(dialect, expr):
+    """Get the SQL of the month of a datetime.
+
+    Parameters
+    ----------
+    dialect : str
+        The name of the sqlalchemy dialect of the connection.
+    expr : str
+        The SQL of the datetime.
+
+    Returns
+    -------
+    sql : str
+        The SQL of the month, as an integer from 1 to 12.
+    """
+    if dialect == "sqlite":
+        return f"CAST(strftime('%m', {expr}) AS INTEGER)"
+    return f"MONTH({expr})"
+
+
+def days_between(dialect, start, end):
+    """Get the SQL of the number of dates between two datetimes.
+
+    Parameters
+    ----------
+    dialect : str
+        The name of the sqlalchemy dialect of the connection.
+    start, end : str
+        The SQL of the datetimes.
+
+    Returns
+    -------
+    sql : str
+        The SQL of the number of days between the dates of `start` and `end`,
+        as `DATEDIFF(end, start)` in MySQL.
+    """
+    if dialect == "sqlite":
+        return f"CAST(julianday(date({end})) - julianday(date({start})) AS INTEGER)"
+    if dialect == "duckdb":
+        return f"date_diff('day', CAST({start} AS DATE), CAST({end} AS DATE))"
+    return f"DATEDIFF({end}, {start})"
+
+
+def seconds_between(dialect, start, end):
+    """Get the SQL of the number of seconds between two datetimes.
+
+    Parameters
+    ----------
+    dialect : str
+        The name of the sqlalchemy dialect of the connection.
+    start, end : str
+        The SQL of the datetimes.
+
+    Returns
+    -------
+    sql : str
+        The SQL of the number of seconds from `start` to `end`, as
+        `TIMESTAMPDIFF(SECOND, start, end)` in MySQL.
+    """
+    if dialect == "sqlite":
+        return f"CAST(ROUND((julianday({end}) - julianday({start})) * 86400) AS INTEGER)"
+    if dialect == "duckdb":
+        return f"date_diff('second', {start}, {end})"
+    return f"TIMESTAMPDIFF(SECOND, {start}, {end})"
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the query implementations.
+
+This module contains code that times the different implementations of a query
+on generated trackpoints, without a database, and checks that they give the
+same results.
+
+    python benchmark.py --points 200000 --workers 4
+
+The window function queries 11 and 12 are checked against a reference with
+the semantics of `LAG() OVER (PARTITION BY activity_id ORDER BY id)`.
+
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+
+from geo import EARTH_RADIUS
+from queries import close_user_sets
+from windows import elevation_gain_by_user
+from windows import invalid_activities_by_user
+
+
+def generate_trackpoints(points, users=50, activities=2000, seed=0):
+    """Generate trackpoints of activities around Beijing.
+
+    Every activity is a random walk starting at a random place and time, with
+    a trackpoint every 5 seconds, so that activities of different users
+    overlap in time and space.
+
+    Parameters
+    ----------
+    points : int
+        The number of trackpoints.
+    users : int, optional
+        The number of users. Defaults to 50.
+    activities : int, optional
+        The number of activities. Defaults to 2000.
+    seed : int, optional
+        The seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The trackpoints, with the columns `user_id`, `activity_id`, `lat`,
+        `lon` and `date_time`.
+    """
+    rng = np.random.default_rng(seed)
+    activity_id = np.sort(rng.integers(0, activities, points))
+    first = np.searchsorted(activity_id, activity_id)
+    step = np.arange(points) - first
+
+    user_id = rng.integers(0, users, activities)
+    start_lat = 39.9 + rng.random(activities) * 0.001
+    start_lon = 116.3 + rng.random(activities) * 0.001
+    start_time = rng.integers(0, 7 * 24 * 60 * 60, activities)
+
+    walk = rng.normal(0, 0.00001, (points, 2))
+    walk = np.cumsum(walk, axis=0) - np.cumsum(walk, axis=0)[first]
+    return pd.DataFrame(
+        {
+            "user_id": pd.Series(user_id[activity_id]).map("{:03d}".format),
+            "activity_id": activity_id,
+            "lat": start_lat[activity_id] + walk[:, 0],
+            "lon": start_lon[activity_id] + walk[:, 1],
+            "date_time": pd.Timestamp("2008-01-01")
+            + pd.to_timedelta(start_time[activity_id] + 5 * step, unit="s"),
+        }
+    )
+
+
+def serial_close_user_sets(query_df):
+    """Find the sets of close users with the original serial loop of query 6.
+
+    Parameters
+    ----------
+    query_df : Pandas DataFrame
+        The trackpoints, as returned by `generate_trackpoints`.
+
+    Returns
+    -------
+    close_users : set
+        The frozensets of users that have been close to each other.
+    """
+    X = (
+        (query_df["date_time"] - query_df["date_time"].min()).dt.total_seconds()
+    ).values.reshape(-1, 1)
+    cluster = DBSCAN(eps=60, min_samples=2).fit(X)
+    query_df = query_df.assign(time_labels=cluster.labels_)
+    query_df = query_df.loc[query_df["time_labels"] != -1]
+
+    close_users = []
+    for tl in query_df["time_labels"].unique():
+        df = query_df.loc[
+            query_df["time_labels"] == tl, ["user_id", "activity_id", "lat", "lon"]
+        ]
+        X = df[["lat", "lon"]].values
+        cluster = DBSCAN(
+            eps=100 / EARTH_RADIUS, min_samples=2, metric="haversine"
+        ).fit(X)
+        df["spatial_labels"] = cluster.labels_
+        df = df.loc[df["spatial_labels"] != -1]
+        df = df.groupby(["spatial_labels"]).agg(
+            user_id=pd.NamedAgg(column="user_id", aggfunc=frozenset)
+        )
+        df = df.loc[df["user_id"].map(len) > 1]
+        close_users.append(df["user_id"].unique())
+    return {s for arr in close_users if arr.size > 1 for s in arr}
+
+
+def benchmark_query_6(query_df, workers):
+    """Time the serial loop of query 6 against the sliced and parallel versions.
+
+    Parameters
+    ----------
+    query_df : Pandas DataFrame
+        The trackpoints, as returned by `generate_trackpoints`.
+    workers : int
+        The number of processes of the parallel version.
+
+    Returns
+    -------
+    timings : dict
+        The time taken by each version in seconds.
+    """
+    runs = {
+        "serial loop": lambda: serial_close_user_sets(query_df),
+        "sliced, 1 worker": lambda: close_user_sets(query_df, workers=1),
+        f"sliced, {workers} workers": lambda: close_user_sets(
+            query_df, workers=workers
+        ),
+    }
+    timings = {}
+    results = {}
+    for name, run in runs.items():
+        start_time = time.time()
+        results[name] = run()
+        timings[name] = time.time() - start_time
+
+    baseline = timings["serial loop"]
+    for name, seconds in timings.items():
+        same = results[name] == results["serial loop"]
+        print(
+            f"{name}: {seconds:.2f} seconds ({baseline / seconds:.1f}x, "
+            f"{len(results[name])} close user sets, same result: {same})"
+        )
+    return timings
+
+
+def lag_window_answers(activity_df, trackpoint_df):
+    """Answer queries 11 and 12 with the LAG window of the SQL queries.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `activity_id` and `user_id`.
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `id`, `activity_id`, `altitude` and
+        `date_time`.
+
+    Returns
+    -------
+    gain_df : Pandas DataFrame
+        The answer to query 11.
+    invalid_df : Pandas DataFrame
+        The answer to query 12.
+    """
+    df = (
+        trackpoint_df[["id", "activity_id", "altitude", "date_time"]]
+        .sort_values("id")
+        .merge(activity_df, on="activity_id")
+    )
+    lag = df.groupby("activity_id")[["altitude", "date_time"]].shift()
+    df["altitude_diff"] = df["altitude"] - lag["altitude"]
+    df["gap"] = (df["date_time"] - lag["date_time"]).dt.total_seconds()
+
+    gain_df = (
+        df.loc[df["altitude_diff"] > 0]
+        .groupby("user_id")["altitude_diff"]
+        .sum()
+        .rename("total_elevation_gain")
+        .reset_index()
+        .sort_values(["total_elevation_gain", "user_id"], ascending=[False, True])
+        .head(20)
+        .reset_index(drop=True)
+    )
+    invalid_df = (
+        df.loc[df["gap"] > 300]
+        .groupby("user_id")["activity_id"]
+        .nunique()
+        .rename("number_of_invalid_activities")
+        .reset_index()
+        .sort_values(
+            ["number_of_invalid_activities", "user_id"], ascending=[False, True]
+        )
+        .reset_index(drop=True)
+    )
+    return (gain_df, invalid_df)
+
+
+def benchmark_windows(query_df):
+    """Time the NumPy answers to queries 11 and 12 against the LAG window.
+
+    Parameters
+    ----------
+    query_df : Pandas DataFrame
+        The trackpoints, as returned by `generate_trackpoints`.
+
+    Returns
+    -------
+    timings : dict
+        The time taken by each version in seconds.
+    """
+    rng = np.random.default_rng(0)
+    trackpoint_df = query_df.assign(
+        id=np.arange(len(query_df)),
+        altitude=np.round(rng.normal(0, 5, len(query_df)).cumsum()),
+        # Leave gaps of more than 5 minutes in some activities
+        date_time=query_df["date_time"]
+        + pd.to_timedelta(
+            np.cumsum(rng.random(len(query_df)) < 0.001) * 600, unit="s"
+        ),
+    )
+    trackpoint_df.loc[rng.random(len(query_df)) < 0.01, "altitude"] = np.nan
+    activity_df = trackpoint_df[["activity_id", "user_id"]].drop_duplicates()
+
+    timings = {}
+    start_time = time.time()
+    reference = lag_window_answers(activity_df, trackpoint_df)
+    timings["LAG window"] = time.time() - start_time
+    start_time = time.time()
+    answers = (
+        elevation_gain_by_user(activity_df, trackpoint_df),
+        invalid_activities_by_user(activity_df, trackpoint_df),
+    )
+    timings["NumPy"] = time.time() - start_time
+
+    same = all(
+        len(a) == len(r)
+        and (a["user_id"].values == r["user_id"].values).all()
+        and np.allclose(a.iloc[:, 1].astype(float), r.iloc[:, 1].astype(float))
+        for a, r in zip(answers, reference)
+    )
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.2f} seconds (same result: {same})")
+    return timings
+
+
+def main():
+    """Generate trackpoints and run the benchmarks."""
+    parser = argparse.ArgumentParser(description="Benchmark the query engines.")
+    parser.add_argument(
+        "-p",
+        "--points",
+        type=int,
+        default=200000,
+        help="number of generated trackpoints (default: 200000)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="number of processes of the parallel versions (default: 4)",
+    )
+    args = parser.parse_args()
+
+    query_df = generate_trackpoints(args.points)
+    print(f"Query 6 on {len(query_df)} trackpoints:")
+    benchmark_query_6(query_df, args.workers)
+    print(f"Queries 11 and 12 on {len(query_df)} trackpoints:")
+    benchmark_windows(query_df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Code to cache the parsed dataset on disk.
+
+This module contains code that stores the DataFrames created by parsing the
+`.plt` files as one NumPy `.npy` file per column, and loads them again,
+optionally memory-mapped. A cache entry is a directory named after a
+fingerprint of the dataset files and the parse settings, so the cache is
+invalidated automatically when any file in the dataset changes.
+
+"""
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from manifest import scan_dataset
+
+# Bump when the layout of the cached DataFrames changes
+CACHE_VERSION = 1
+
+
+def dataset_fingerprint(dataset_path, *params):
+    """Compute a fingerprint of the dataset files and the parse settings.
+
+    The fingerprint covers the path, size and modification time of every
+    `.plt` and `labels.txt` file and of `labeled_ids.txt`, without reading the
+    files.
+
+    Parameters
+    ----------
+    dataset_path : str
+        Path to the `dataset` folder.
+    *params
+        Parse settings that change the parsed DataFrames.
+
+    Returns
+    -------
+    fingerprint : str
+        The hexadecimal SHA-1 digest of the dataset state.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(repr((CACHE_VERSION,) + params).encode())
+    sha1.update(scan_dataset(dataset_path + "Data/").to_csv(index=False).encode())
+    stat = os.stat(dataset_path + "labeled_ids.txt")
+    sha1.update(repr((stat.st_size, stat.st_mtime)).encode())
+    return sha1.hexdigest()
+
+
+def save_frame(path, df):
+    """Save a DataFrame as one `.npy` file per column.
+
+    Columns with missing values that NumPy cannot hold, such as strings and
+    nullable integers, are stored with a separate mask of the missing values.
+    Object columns holding other values than strings, such as the `Decimal`
+    aggregates of MySQL, are pickled so that their values come back unchanged.
+    The columns are saved by position, so their names need not be unique.
+
+    Parameters
+    ----------
+    path : str
+        The directory to save the DataFrame in.
+    df : Pandas DataFrame
+        The DataFrame to save.
+
+    """
+    os.makedirs(path)
+    columns = []
+    for i, col in enumerate(df.columns):
+        series = df.iloc[:, i]
+        mask = series.isna().values
+        pickle = False
+        if series.dtype == object and not all(
+            isinstance(value, str) for value in series.dropna()
+        ):
+            values = series.values
+            mask = None
+            pickle = True
+        elif series.dtype == object:
+            values = series.fillna("").values.astype(str)
+        elif pd.api.types.is_extension_array_dtype(series.dtype):
+            values = series.fillna(0).values.astype(series.dtype.numpy_dtype)
+        else:
+            values = series.values
+            mask = None
+        np.save(os.path.join(path, f"{i}.npy"), values, allow_pickle=pickle)
+        if mask is not None and mask.any():
+            np.save(os.path.join(path, f"{i}.mask.npy"), mask, allow_pickle=False)
+        columns.append({"name": col, "dtype": str(series.dtype), "pickle": pickle})
+
+    with open(os.path.join(path, "columns.json"), "w") as f:
+        json.dump(columns, f)
+
+
+def load_columns(path, mmap=True):
+    """Load the columns of a saved DataFrame as NumPy arrays.
+
+    Parameters
+    ----------
+    path : str
+        The directory the DataFrame was saved in.
+    mmap : bool, optional
+        Memory-map the column files instead of reading them. Defaults to True.
+        Pickled columns are always read.
+
+    Returns
+    -------
+    columns : list
+        The column arrays in the order of the columns, as tuples of the
+        array and the mask of its missing values, or None for columns without
+        missing values.
+    """
+    with open(os.path.join(path, "columns.json"), "r") as f:
+        columns = json.load(f)
+
+    arrays = []
+    for i, col in enumerate(columns):
+        pickle = col.get("pickle", False)
+        values = np.load(
+            os.path.join(path, f"{i}.npy"),
+            mmap_mode=None if pickle or not mmap else "r",
+            allow_pickle=pickle,
+        )
+        mask_path = os.path.join(path, f"{i}.mask.npy")
+        mask = np.load(mask_path) if os.path.exists(mask_path) else None
+        arrays.append((values, mask))
+    return arrays
+
+
+def load_frame(path, mmap=True):
+    """Load a saved DataFrame.
+
+    Parameters
+    ----------
+    path : str
+        The directory the DataFrame was saved in.
+    mmap : bool, optional
+        Memory-map the column files instead of reading them. Defaults to True.
+
+    Returns
+    -------
+    df : Pandas DataFrame
+        The saved DataFrame.
+    """
+    with open(os.path.join(path, "columns.json"), "r") as f:
+        columns = json.load(f)
+    arrays = load_columns(path, mmap=mmap)
+
+    data = {}
+    for i, (col, (values, mask)) in enumerate(zip(columns, arrays)):
+        if col["dtype"] == "object" and not col.get("pickle", False):
+            series = pd.Series(values.astype(object))
+            if mask is not None:
+                series[mask] = np.nan
+        elif col["dtype"] == "Int64":
+            mask = mask if mask is not None else np.zeros(len(values), dtype=bool)
+            series = pd.Series(pd.arrays.IntegerArray(np.asarray(values), mask))
+        else:
+            series = pd.Series(values)
+        data[i] = series
+    df = pd.DataFrame(data, columns=range(len(columns)))
+    df.columns = [col["name"] for col in columns]
+    return df
+
+
+def cached_batches(cache_dir, fingerprint, stream, names):
+    """Load batches of DataFrames from the cache, or create and cache them.
+
+    On a cache hit the batches are loaded from the entry named `fingerprint`.
+    On a miss the batches of `stream` are saved while they are yielded, and
+    the entry is only made visible, replacing any stale entries, once the
+    stream is exhausted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    fingerprint : str
+        The fingerprint of the dataset, as returned by `dataset_fingerprint`.
+    stream : iterator
+        The batches to cache, as tuples of DataFrames or None.
+    names : list
+        The names of the DataFrames in a batch.
+
+    Yields
+    ------
+    batch : tuple
+        The DataFrames of a batch, or None where the batch has no DataFrame.
+    """
+    entry = os.path.join(cache_dir, fingerprint)
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(entry):
+        batches = sorted(os.listdir(entry))
+        print(f"Loading {len(batches)} batches from cache {entry}.")
+        for batch in batches:
+            yield tuple(
+                load_frame(os.path.join(entry, batch, name))
+                if os.path.exists(os.path.join(entry, batch, name))
+                else None
+                for name in names
+            )
+        return
+
+    # Write into a temporary directory, so that an interrupted run never
+    # leaves a partial entry behind
+    tmp_entry = entry + ".tmp"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    try:
+        for i, batch in enumerate(stream):
+            for name, df in zip(names, batch):
+                if df is not None:
+                    save_frame(os.path.join(tmp_entry, f"{i:06d}", name), df)
+            yield batch
+    except BaseException:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        raise
+
+    # Replace stale entries by the new one
+    for stale in os.listdir(cache_dir):
+        if _is_entry(stale) and stale != os.path.basename(tmp_entry):
+            shutil.rmtree(os.path.join(cache_dir, stale), ignore_errors=True)
+    os.rename(tmp_entry, entry)
+    print(f"Parsed data cached in {entry}.")
+
+
+def _is_entry(name):
+    """Helper function to check if a file name is a (temporary) cache entry.
+
+    Parameters
+    ----------
+    name : str
+        The file name.
+
+    Returns
+    -------
+    is_entry : bool
+        True if the name is a fingerprint, optionally with a `.tmp` suffix.
+    """
+    name = name[: -len(".tmp")] if name.endswith(".tmp") else name
+    return len(name) == 40 and all(c in "0123456789abcdef" for c in name)
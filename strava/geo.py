@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Code to compute distances between coordinates on the Earth.
+
+This module contains vectorized NumPy versions of the distance computations
+used by the queries, so whole columns of trackpoints can be compared at once,
+and the length of many paths can be summed without a loop over the paths.
+
+"""
+import numpy as np
+import pandas as pd
+
+# Arithmetic mean radius of the Earth in meters
+# https://en.wikipedia.org/wiki/Earth_radius#Arithmetic_mean_radius
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Compute the haversine distance between coordinates.
+
+    Parameters
+    ----------
+    lat1, lon1 : array_like
+        The latitudes and longitudes of the first coordinates in degrees.
+    lat2, lon2 : array_like
+        The latitudes and longitudes of the second coordinates in degrees.
+
+    Returns
+    -------
+    distance : ndarray
+        The distances in meters.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def to_unit_vectors(lat, lon):
+    """Convert coordinates to points on the unit sphere.
+
+    Parameters
+    ----------
+    lat, lon : array_like
+        The latitudes and longitudes in degrees.
+
+    Returns
+    -------
+    xyz : ndarray
+        The points as rows of x, y and z.
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+def chord_length(distance):
+    """Compute the straight line distance between two points on the unit sphere.
+
+    Parameters
+    ----------
+    distance : float
+        The haversine distance between the points in meters.
+
+    Returns
+    -------
+    chord : float
+        The length of the chord between the points on the unit sphere.
+    """
+    return 2 * np.sin(distance / (2 * EARTH_RADIUS))
+
+
+def bounding_box(lat, lon, radius):
+    """Compute the smallest latitude and longitude box around a circle.
+
+    The longitude extent is the one of the points of the circle where it is
+    tangent to a meridian, which lie poleward of the center. Boxes that reach
+    a pole span all longitudes, and boxes crossing the antimeridian are
+    clipped to it.
+
+    Parameters
+    ----------
+    lat, lon : float
+        The latitude and longitude of the center of the circle in degrees.
+    radius : float
+        The radius of the circle in meters.
+
+    Returns
+    -------
+    box : tuple
+        The `min_lat`, `min_lon`, `max_lat` and `max_lon` of the box in
+        degrees.
+    """
+    angle = radius / EARTH_RADIUS
+    min_lat = max(lat - np.degrees(angle), -90.0)
+    max_lat = min(lat + np.degrees(angle), 90.0)
+    if min_lat == -90.0 or max_lat == 90.0 or angle >= np.pi / 2:
+        return (min_lat, -180.0, max_lat, 180.0)
+    ratio = np.sin(angle) / np.cos(np.radians(lat))
+    if ratio >= 1:
+        return (min_lat, -180.0, max_lat, 180.0)
+    dlon = np.degrees(np.arcsin(ratio))
+    return (min_lat, max(lon - dlon, -180.0), max_lat, min(lon + dlon, 180.0))
+
+
+def path_distances(df, by="activity_id"):
+    """Compute the length of the paths through consecutive trackpoints.
+
+    The distances between all consecutive trackpoints are computed in one
+    pass, and the distances across the boundary between two paths are masked
+    out. The trackpoints are sorted on `by` with a stable sort, so the order of
+    the trackpoints within a path is kept.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The trackpoints, with the columns `lat`, `lon` and `by`.
+    by : str, optional
+        The column identifying the path of a trackpoint. Defaults to
+        `activity_id`.
+
+    Returns
+    -------
+    distances : Pandas Series
+        The length of each path in meters, indexed by `by`.
+    total : float
+        The total length of the paths in meters.
+    """
+    df = df.sort_values(by, kind="stable")
+    keys = df[by].values
+    if len(keys) == 0:
+        return (pd.Series([], dtype=float, name="distance"), 0.0)
+    lat = df["lat"].values
+    lon = df["lon"].values
+
+    # Distance from every trackpoint to the previous one, and zero for the
+    # first trackpoint of a path
+    steps = np.zeros(len(keys))
+    steps[1:] = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    steps[starts] = 0
+
+    distances = pd.Series(
+        np.add.reduceat(steps, starts), index=keys[starts], name="distance"
+    )
+    distances.index.name = by
+    return (distances, float(distances.sum()))
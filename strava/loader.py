@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Code to bulk load Pandas DataFrames into the `TDT4225ProjectGroup78` database.
+
+This module contains the different ways of inserting a DataFrame into a MySQL
+table. `to_sql` is the plain Pandas insert. `infile` stages the rows in a
+temporary tab separated file and uses `LOAD DATA LOCAL INFILE`, and
+`executemany` sends the rows in large multi-row `INSERT` batches. The two bulk
+methods run inside a single transaction per call, with unique and foreign key
+checks disabled while loading, and are only available with the `mysql`
+backend.
+
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Methods that can be used to load a DataFrame into a table
+LOAD_METHODS = ("to_sql", "infile", "executemany")
+
+# Default number of rows sent per `executemany` call
+CHUNKSIZE = 50000
+
+
+def load_table(cnx, table, df, method="to_sql", chunksize=CHUNKSIZE):
+    """Insert a DataFrame into a table.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object. Must be created with
+        `local_infile=True` for the `infile` method.
+    table : str
+        The name of the table.
+    df : Pandas DataFrame
+        The rows to insert. The column names must match the table.
+    method : str, optional
+        One of `LOAD_METHODS`. Defaults to `to_sql`.
+    chunksize : int, optional
+        The number of rows sent per `executemany` call.
+
+    """
+    if method == "to_sql":
+        df.to_sql(table, cnx, if_exists="append", index=False)
+        return
+    if method not in LOAD_METHODS:
+        raise ValueError(f"Unknown load method: {method}")
+    if cnx.dialect.name != "mysql":
+        raise ValueError(f"The {method} load method needs the mysql backend")
+
+    columns = ", ".join(f"`{col}`" for col in df.columns)
+    with _bulk_transaction(cnx.connection) as cursor:
+        if method == "infile":
+            _load_infile(cursor, table, columns, df)
+        else:
+            _load_executemany(cursor, table, columns, df, chunksize)
+
+
+@contextmanager
+def _bulk_transaction(dbapi_cnx):
+    """Helper context manager running a bulk load in a single transaction.
+
+    Autocommit, unique checks and foreign key checks are turned off for the
+    session while loading, and restored to their previous values afterwards.
+    The transaction is committed on success and rolled back on failure.
+
+    Parameters
+    ----------
+    dbapi_cnx : :obj:
+        The DBAPI (pymysql) connection object.
+
+    Yields
+    ------
+    cursor : :obj:
+        The DBAPI cursor used to load the rows.
+    """
+    cursor = dbapi_cnx.cursor()
+    cursor.execute("SELECT @@autocommit, @@unique_checks, @@foreign_key_checks")
+    autocommit, unique_checks, foreign_key_checks = cursor.fetchone()
+    cursor.execute("SET autocommit = 0")
+    cursor.execute("SET unique_checks = 0")
+    cursor.execute("SET foreign_key_checks = 0")
+    try:
+        yield cursor
+        dbapi_cnx.commit()
+    except Exception:
+        dbapi_cnx.rollback()
+        raise
+    finally:
+        cursor.execute(f"SET unique_checks = {int(unique_checks)}")
+        cursor.execute(f"SET foreign_key_checks = {int(foreign_key_checks)}")
+        cursor.execute(f"SET autocommit = {int(autocommit)}")
+        cursor.close()
+
+
+def _load_infile(cursor, table, columns, df):
+    """Helper function to load a DataFrame with `LOAD DATA LOCAL INFILE`.
+
+    Parameters
+    ----------
+    cursor : :obj:
+        The DBAPI cursor object.
+    table : str
+        The name of the table.
+    columns : str
+        The comma separated column list of the table.
+    df : Pandas DataFrame
+        The rows to insert.
+
+    """
+    # Stage the rows in a tab separated file. MySQL reads `\N` as NULL.
+    df = _convert_bool_columns(df)
+    fd, path = tempfile.mkstemp(suffix=".tsv")
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            df.to_csv(
+                f,
+                sep="\t",
+                header=False,
+                index=False,
+                na_rep="\\N",
+                date_format="%Y-%m-%d %H:%M:%S",
+            )
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE `{table}` "
+            "FIELDS TERMINATED BY '\\t' "
+            f"LINES TERMINATED BY %s ({columns})",
+            (path, os.linesep),
+        )
+    finally:
+        os.remove(path)
+
+
+def _load_executemany(cursor, table, columns, df, chunksize):
+    """Helper function to load a DataFrame with batched multi-row inserts.
+
+    pymysql rewrites `executemany` on an `INSERT ... VALUES` statement into
+    multi-row inserts, so every chunk is sent in a few large statements.
+
+    Parameters
+    ----------
+    cursor : :obj:
+        The DBAPI cursor object.
+    table : str
+        The name of the table.
+    columns : str
+        The comma separated column list of the table.
+    df : Pandas DataFrame
+        The rows to insert.
+    chunksize : int
+        The number of rows sent per `executemany` call.
+
+    """
+    df = _convert_bool_columns(df)
+    # pymysql only knows the Python types, so convert datetimes to strings
+    # and NaN/NaT to None
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime("%Y-%m-%d %H:%M:%S")
+    df = df.astype(object).where(pd.notnull(df), None)
+    rows = df.values.tolist()
+
+    placeholders = ", ".join(["%s"] * len(df.columns))
+    statement = f"INSERT INTO `{table}` ({columns}) VALUES ({placeholders})"
+    for start in range(0, len(rows), chunksize):
+        cursor.executemany(statement, rows[start : start + chunksize])
+
+
+def _convert_bool_columns(df):
+    """Helper function to store boolean columns as integers.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The rows to insert.
+
+    Returns
+    -------
+    df : Pandas DataFrame
+        A copy of `df` with boolean columns converted to 0 and 1.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].astype(int)
+    return df
@@ -5,17 +5,278 @@ Author: Simen Omholt-Jensen
 
 This module contains code that runs the strava interface.
 """
+import os
 import sys
 import getpass
+import argparse
+
+import pandas as pd
+from tabulate import tabulate
 
 import tables
 import database
 
-from tables import TABLES
+from tables import get_tables
+from tables import get_indexes
+from tables import STORAGES
+from tables import SCHEMAS
+from tables import PARTITIONS
 from tables import DB_NAME
 from database import setup_database
+from database import create_indexes
 from database import insert_data
 from database import query_database
+from database import BATCH_SIZE
+from database import DATASET_PATH
+from loader import LOAD_METHODS
+from loader import CHUNKSIZE
+from proximity import ENGINES
+from queries import QUERIES
+from windows import WINDOW_ENGINES
+from resultcache import QueryCache
+from resultcache import MAX_BYTES
+from backends import BACKENDS
+from backends import POOL_RECYCLE
+from backends import get_engine
+from metrics import MetricsLog
+
+def parse_args():
+    """Parse the command line arguments.
+
+    Returns
+    -------
+    args : :obj:
+        The argparse.Namespace object holding the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create, fill and query the `TDT4225ProjectGroup78` database."
+    )
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        choices=BACKENDS,
+        default=["mysql"],
+        help="backends to store the database in. With more than one backend "
+        "the ingest and query timings are compared (default: mysql)",
+    )
+    parser.add_argument(
+        "--database-path",
+        default=None,
+        help="file of the sqlite or duckdb database (default: "
+        f"{DB_NAME}.sqlite or {DB_NAME}.duckdb)",
+    )
+    parser.add_argument(
+        "--dataset-path",
+        default=DATASET_PATH,
+        help=f"path to the dataset folder (default: {DATASET_PATH})",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="file to append the time, rows and peak memory of every parse, "
+        "insert and query stage to as JSON lines (default: none)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="directory to dump a cProfile file per stage to (default: none)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to parse the dataset (default: 1)",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="minimum number of trackpoints parsed and inserted at a time "
+        f"(default: {BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "-m",
+        "--load-method",
+        choices=LOAD_METHODS,
+        default="to_sql",
+        help="method used to load the tables (default: to_sql)",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        type=int,
+        default=CHUNKSIZE,
+        help="number of rows per executemany call when loading with "
+        f"executemany (default: {CHUNKSIZE})",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="keep the existing database and only insert the files that changed "
+        "since the last run",
+    )
+    parser.add_argument(
+        "-s",
+        "--storage",
+        choices=STORAGES,
+        default="activity",
+        help="store the trackpoints once per activity, or once per trajectory "
+        "with activities mapped to it (default: activity)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="directory to cache the parsed dataset in, reused until a file in "
+        "the dataset changes (default: no cache)",
+    )
+    parser.add_argument(
+        "--schema",
+        choices=SCHEMAS,
+        default="default",
+        help="schema of the tables; compact narrows the TrackPoint columns and "
+        "creates the indexes after the insert (default: default)",
+    )
+    parser.add_argument(
+        "--partition",
+        choices=PARTITIONS,
+        default="none",
+        help="range partition the TrackPoint table on date_time by year or by "
+        "month (default: none)",
+    )
+    parser.add_argument(
+        "--spatial",
+        action="store_true",
+        help="add a POINT column with a spatial index to the TrackPoint table, "
+        "used by --lookup (mysql only)",
+    )
+    parser.add_argument(
+        "--lookup",
+        type=float,
+        nargs=3,
+        default=None,
+        metavar=("LAT", "LON", "METERS"),
+        help="print the activities passing within METERS of a point, and time "
+        "the radius and bounding box lookups (default: none)",
+    )
+    parser.add_argument(
+        "--lod",
+        type=int,
+        nargs="+",
+        default=[],
+        metavar="METERS",
+        help="simplify the trajectories at these tolerances into the "
+        "TrackPointLOD table (default: none)",
+    )
+    parser.add_argument(
+        "--lod-level",
+        type=int,
+        default=None,
+        metavar="METERS",
+        help="answer query 10 from the simplified trajectories at this "
+        "tolerance, unless --stats is given (default: full resolution)",
+    )
+    parser.add_argument(
+        "--lod-report",
+        action="store_true",
+        help="print the rows, distance and deviation of every tolerance "
+        "against the full resolution",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="print the size of every table, the time taken by every query and "
+        "the execution plan of query 10",
+    )
+    parser.add_argument(
+        "--proximity-engine",
+        choices=ENGINES,
+        default="dbscan",
+        help="engine used to find the close users of query 6; grid joins the "
+        "trackpoints on 60 second and 100 meter buckets (default: dbscan)",
+    )
+    parser.add_argument(
+        "--query-workers",
+        type=int,
+        default=1,
+        help="number of processes used to cluster the trackpoints of query 6 "
+        "with the dbscan engine (default: 1)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="answer queries 10 to 12 from the ActivityStats table instead of "
+        "the trackpoints",
+    )
+    parser.add_argument(
+        "--stream-chunksize",
+        type=int,
+        default=None,
+        help="stream the trackpoints of queries 6 and 10, of queries 11 and 12 "
+        "with the numpy window engine, and of the level of detail report from "
+        "the server in chunks of this many rows (default: read all at once)",
+    )
+    parser.add_argument(
+        "--window-engine",
+        choices=WINDOW_ENGINES,
+        default="sql",
+        help="answer queries 11 and 12 with window functions in MySQL, or "
+        "from the trackpoint columns with NumPy (default: sql)",
+    )
+    parser.add_argument(
+        "--check-window-engines",
+        action="store_true",
+        help="check that both window engines give the same answers to "
+        "queries 11 and 12",
+    )
+    parser.add_argument(
+        "-q",
+        "--queries",
+        type=int,
+        nargs="+",
+        choices=sorted(QUERIES),
+        default=None,
+        metavar="N",
+        help="numbers of the queries to run (default: all)",
+    )
+    parser.add_argument(
+        "--query-threads",
+        type=int,
+        default=1,
+        help="number of queries run at the same time, each on its own "
+        "connection (default: 1)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=None,
+        help="number of pooled MySQL connections shared by the setup, the "
+        "ingest and the queries (default: number of query threads)",
+    )
+    parser.add_argument(
+        "--pool-recycle",
+        type=int,
+        default=POOL_RECYCLE,
+        help="number of seconds after which a pooled MySQL connection is "
+        f"replaced (default: {POOL_RECYCLE})",
+    )
+    parser.add_argument(
+        "--result-cache-dir",
+        default=None,
+        help="directory to cache the query results in, reused until the next "
+        "insert (default: no cache)",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        type=int,
+        default=MAX_BYTES // 2**20,
+        help="size of the query result cache directory in MB "
+        f"(default: {MAX_BYTES // 2**20})",
+    )
+    return parser.parse_args()
+
 
 def main():
     """Sets up the database and runs the program.
@@ -26,17 +287,134 @@ def main():
     answer the questions found in the assignment text.
 
     """
+    args = parse_args()
 
     # Prompt the user for their MySQL login inforamtion
-    user = input("Enter MySQL user: ")
-    password = getpass.getpass(prompt="Enter MySQL password: ")
+    user, password = None, None
+    if "mysql" in args.backend:
+        user = input("Enter MySQL user: ")
+        password = getpass.getpass(prompt="Enter MySQL password: ")
+
+    metrics = None
+    if args.metrics_file is not None or args.profile_dir is not None:
+        metrics = MetricsLog(args.metrics_file, args.profile_dir)
+
+    timings = {}
+    for backend in args.backend:
+        timings[backend] = run_backend(args, backend, user, password, metrics)
+
+    if len(timings) > 1:
+        print("Backend timings in seconds:")
+        timing_df = pd.DataFrame(timings).rename_axis("stage").reset_index()
+        print(
+            tabulate(
+                timing_df.round(3), headers="keys", showindex=False, tablefmt="orgtbl"
+            )
+        )
+
+
+def run_backend(args, backend, user, password, metrics=None):
+    """Create, fill and query the database on one backend.
+
+    The engine of the backend is created once, and its connection pool is
+    shared by the setup, the ingest and the queries.
+
+    Parameters
+    ----------
+    args : :obj:
+        The argparse.Namespace object holding the parsed arguments.
+    backend : str
+        One of `backends.BACKENDS`.
+    user : str
+        The entered MySQL user.
+    password : str
+        The entered MySQL password.
+    metrics : :obj:, optional
+        The `metrics.MetricsLog` to record the stages in. Defaults to no
+        metrics.
+
+    Returns
+    -------
+    timings : dict
+        The time taken by the ingest, and by every query, in seconds.
+    """
+    print(f"Backend: {backend}")
+    pool_size = args.pool_size
+    if pool_size is None:
+        pool_size = args.query_threads
+    sql_engine = get_engine(
+        backend,
+        user,
+        password,
+        DB_NAME,
+        args.database_path,
+        pool_size=pool_size,
+        pool_recycle=args.pool_recycle,
+        connect_args={"local_infile": args.load_method == "infile"},
+    )
 
     # create strava database
-    setup_database(user, password, DB_NAME, TABLES)
-    insert_data(user, password, DB_NAME)
+    setup_database(
+        sql_engine,
+        DB_NAME,
+        get_tables(
+            args.storage, args.schema, args.partition, args.spatial, bool(args.lod)
+        ),
+        incremental=args.incremental,
+    )
+    insert_timings = insert_data(
+        sql_engine,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        method=args.load_method,
+        chunksize=args.chunksize,
+        incremental=args.incremental,
+        storage=args.storage,
+        cache_dir=args.cache_dir,
+        schema=args.schema,
+        partition=args.partition,
+        dataset_path=os.path.join(args.dataset_path, ""),
+        lod=tuple(args.lod),
+        metrics=metrics,
+    )
+    create_indexes(
+        sql_engine,
+        get_indexes(args.storage, args.schema, args.partition, args.spatial),
+    )
 
     # Perform queries
-    query_database(user, password, DB_NAME)
+    cache = None
+    if args.result_cache_dir is not None:
+        cache = QueryCache(
+            os.path.join(args.result_cache_dir, backend),
+            max_bytes=args.result_cache_size * 2**20,
+        )
+    _, latencies = query_database(
+        sql_engine,
+        storage=args.storage,
+        report=args.report,
+        engine=args.proximity_engine,
+        workers=args.query_workers,
+        stats=args.stats,
+        numbers=args.queries,
+        threads=args.query_threads,
+        cache=cache,
+        chunksize=args.stream_chunksize,
+        window_engine=args.window_engine,
+        check_windows=args.check_window_engines,
+        lookup=args.lookup,
+        spatial=args.spatial and backend == "mysql",
+        lod=args.lod_level,
+        report_lod=args.lod_report,
+        metrics=metrics,
+    )
+    sql_engine.dispose()
+
+    timings = {"ingest": sum(insert_timings.values())}
+    timings.update(
+        {f"query {number}": seconds for number, seconds in latencies.items()}
+    )
+    return timings
 
 
 if __name__ == "__main__":
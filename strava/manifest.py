@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Code to keep track of the dataset files inserted into the database.
+
+This module contains code that records the size, modification time and content
+hash of every `.plt` and `labels.txt` file in the `dataset/Data` folder, and
+compares the files on disk against the `Manifest` table to find the files that
+were added, changed or removed since the last ingest.
+
+"""
+import os
+import hashlib
+
+import pandas as pd
+
+# Columns of the `Manifest` table
+MANIFEST_COLS = [
+    "path",
+    "user_id",
+    "size",
+    "mtime",
+    "sha1",
+    "first_activity_id",
+    "activity_count",
+]
+
+
+def file_sha1(path, block_size=1 << 20):
+    """Compute the SHA-1 hash of a file's content.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    block_size : int, optional
+        The number of bytes read at a time.
+
+    Returns
+    -------
+    sha1 : str
+        The hexadecimal SHA-1 digest.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_record(data_path, path, sha1=True):
+    """Create the manifest record of a single file.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the `dataset/Data` folder.
+    path : str
+        Path to the file, relative to `data_path`.
+    sha1 : bool, optional
+        Whether to hash the file. Defaults to True, otherwise the `sha1` of
+        the record is None.
+
+    Returns
+    -------
+    record : dict
+        The `path`, `user_id`, `size`, `mtime` and `sha1` of the file.
+    """
+    stat = os.stat(data_path + path)
+    return {
+        "path": path,
+        "user_id": path.split("/")[0],
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha1": file_sha1(data_path + path) if sha1 else None,
+    }
+
+
+def scan_dataset(data_path):
+    """List the `.plt` and `labels.txt` files of all users.
+
+    Only the file sizes and modification times are read, the files themselves
+    are not opened.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the `dataset/Data` folder.
+
+    Returns
+    -------
+    disk_df : Pandas DataFrame
+        Table of the `path`, `user_id`, `size` and `mtime` of every file.
+    """
+    records = []
+    for uid in sorted(os.listdir(data_path)):
+        trajectory_path = f"{data_path}{uid}/Trajectory/"
+        paths = [f"{uid}/Trajectory/{f}" for f in os.listdir(trajectory_path)]
+        if os.path.exists(f"{data_path}{uid}/labels.txt"):
+            paths.append(f"{uid}/labels.txt")
+        for path in paths:
+            stat = os.stat(data_path + path)
+            records.append((path, uid, stat.st_size, stat.st_mtime))
+    return pd.DataFrame(records, columns=["path", "user_id", "size", "mtime"])
+
+
+def is_labels(paths):
+    """Check which manifest paths are `labels.txt` files.
+
+    Parameters
+    ----------
+    paths : Pandas Series
+        The manifest paths.
+
+    Returns
+    -------
+    mask : Pandas Series
+        True for the `labels.txt` files.
+    """
+    return paths.str.endswith("/labels.txt")
+
+
+def diff_manifest(data_path, disk_df, manifest_df):
+    """Compare the files on disk against the `Manifest` table.
+
+    Files whose size and modification time are unchanged are assumed to be
+    unchanged. The other files are hashed, and only counted as changed if
+    their content hash differs from the manifest. Files without a hash in the
+    manifest, i.e. files skipped by the size pre-filter, count as changed
+    whenever their size or modification time changed. When a user's
+    `labels.txt` changes, all trajectories of the user are parsed again, as
+    their transportation modes may have changed.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the `dataset/Data` folder.
+    disk_df : Pandas DataFrame
+        The files on disk, as returned by `scan_dataset`.
+    manifest_df : Pandas DataFrame
+        The rows of the `Manifest` table.
+
+    Returns
+    -------
+    files : dict
+        The `.plt` file names to parse for each user id.
+    removed_df : Pandas DataFrame
+        The manifest rows whose files were changed or removed. Their
+        activities must be deleted before the new files are inserted.
+    labels_df : Pandas DataFrame
+        The manifest rows of new or changed `labels.txt` files.
+    touched_df : Pandas DataFrame
+        The manifest rows of files with a new modification time but unchanged
+        content, with their new `mtime`.
+    """
+    merged = disk_df.merge(
+        manifest_df, on="path", how="outer", suffixes=("", "_db"), indicator=True
+    )
+    added = merged.loc[merged["_merge"] == "left_only", "path"]
+    deleted = merged.loc[merged["_merge"] == "right_only", "path"]
+    both = merged.loc[merged["_merge"] == "both"]
+
+    # Hash the files that look modified, to find the ones that really are
+    stale = both.loc[
+        (both["size"] != both["size_db"]) | (both["mtime"] != both["mtime_db"])
+    ]
+    stale_sha1 = stale["path"].map(lambda path: file_sha1(data_path + path))
+    changed = stale.loc[stale_sha1 != stale["sha1"], "path"]
+    touched_df = (
+        manifest_df.set_index("path")
+        .loc[stale.loc[stale_sha1 == stale["sha1"], "path"]]
+        .reset_index()
+    )
+    touched_df["mtime"] = touched_df["path"].map(disk_df.set_index("path")["mtime"])
+
+    # Users whose labels changed have all their trajectories parsed again
+    modified = pd.concat([added, deleted, changed])
+    relabeled = modified.loc[is_labels(modified)].str.split("/").str[0]
+    redo = disk_df.loc[disk_df["user_id"].isin(relabeled), "path"]
+
+    parse = pd.concat([added, changed, redo]).drop_duplicates()
+    removed = pd.concat([deleted, changed, redo])
+    removed_df = manifest_df.loc[manifest_df["path"].isin(removed)]
+
+    files = {}
+    for path in parse.loc[~is_labels(parse)].sort_values():
+        uid, _, filename = path.split("/")
+        files.setdefault(uid, []).append(filename)
+
+    labels_df = pd.DataFrame(
+        [file_record(data_path, path) for path in parse.loc[is_labels(parse)]],
+        columns=MANIFEST_COLS,
+    )
+    labels_df["activity_count"] = 0
+    return (files, removed_df, labels_df, touched_df)
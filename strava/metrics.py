@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Code to record the time and memory used by the stages of the pipeline.
+
+This module contains code that wraps a stage of the pipeline, such as the
+parse of one user, the insert of one table or one query, and records its wall
+time, CPU time, number of rows, rows per second, the peak resident set size
+of the process, and how much the stage raised that peak. The records are kept in memory and appended to a file as
+JSON lines, one record per line. Every stage can optionally be profiled with
+`cProfile`, with one `.prof` file per stage, to be read with `pstats` or
+`snakeviz`.
+
+Stages that run in worker processes are measured there with `measure`, and
+their records are emitted by the parent process.
+
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """Get the peak resident set size of the current process.
+
+    Returns
+    -------
+    peak : float
+        The peak resident set size in MB, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def cpu_time():
+    """Get the CPU time of the current thread.
+
+    Returns
+    -------
+    seconds : float
+        The user and system CPU time of the thread, or of the whole process
+        where the time of a thread is not available.
+    """
+    if resource is not None and hasattr(resource, "RUSAGE_THREAD"):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time.process_time()
+
+
+def measure(func, *args, stage="stage", labels=None, profile_path=None):
+    """Call a function, and measure it as a stage.
+
+    Parameters
+    ----------
+    func : callable
+        The function to call.
+    *args
+        The arguments of `func`.
+    stage : str, optional
+        The name of the stage. Defaults to `stage`.
+    labels : dict, optional
+        Fields added to the record, such as the user or table of the stage.
+    profile_path : str, optional
+        File to dump the `cProfile` statistics of the call to. Defaults to no
+        profiling.
+
+    Returns
+    -------
+    result : object
+        The return value of `func`.
+    record : dict
+        The measurements of the stage, see `MetricsLog.stage`.
+    """
+    record = {"stage": stage, **(labels or {}), "rows": None}
+    start = _start(profile_path)
+    try:
+        result = func(*args)
+    finally:
+        _finish(record, start, profile_path)
+    return (result, record)
+
+
+def stage(metrics, name, **labels):
+    """Measure a stage with a metrics log, or do nothing without one.
+
+    Parameters
+    ----------
+    metrics : :obj:
+        The `MetricsLog`, or None.
+    name : str
+        The name of the stage.
+    **labels
+        Fields added to the record.
+
+    Returns
+    -------
+    context : :obj:
+        A context manager yielding the record of the stage, see
+        `MetricsLog.stage`.
+    """
+    if metrics is None:
+        return _no_stage()
+    return metrics.stage(name, **labels)
+
+
+@contextmanager
+def _no_stage():
+    """Helper context manager standing in for a stage without a metrics log.
+
+    Yields
+    ------
+    record : dict
+        An empty record, which is not kept.
+    """
+    yield {}
+
+
+class MetricsLog:
+    """Log of the measurements of the stages of the pipeline.
+
+    Parameters
+    ----------
+    path : str, optional
+        File to append the records to as JSON lines. Defaults to keeping the
+        records in memory only.
+    profile_dir : str, optional
+        Directory to dump a `cProfile` file per stage to. Only one stage can
+        be profiled at a time, so a stage starting while another one is
+        profiled in a concurrent thread is not profiled, which is printed.
+        Defaults to no profiling.
+
+    Attributes
+    ----------
+    records : list
+        The records of all measured stages.
+    """
+
+    def __init__(self, path=None, profile_dir=None):
+        self.path = path
+        self.profile_dir = profile_dir
+        self.records = []
+        self._profiles = 0
+        self._lock = threading.Lock()
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """Measure a stage.
+
+        The record yielded holds the name of the stage and its labels. The
+        caller sets its `rows`, and the measurements are added when the stage
+        ends: the `wall_seconds`, the `cpu_seconds` of the thread running the
+        stage, the `rows_per_sec`, the `peak_rss_mb` of the process so far,
+        and the `peak_rss_delta_mb` it grew by during the stage. The peak of
+        the process can not be reset, so a stage that stays below the peak
+        of an earlier stage has a delta of 0. Stages running at the same time
+        in other threads add to the delta.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage, such as `parse`, `insert` or `query`.
+        **labels
+            Fields added to the record, such as the user, table or query.
+
+        Yields
+        ------
+        record : dict
+            The record of the stage.
+        """
+        record = {"stage": name, **labels, "rows": None}
+        profile_path = self.profile_path(name, labels)
+        start = _start(profile_path)
+        try:
+            yield record
+        finally:
+            self.emit(_finish(record, start, profile_path))
+
+    def profile_path(self, name, labels):
+        """Get the file the profile of a stage is dumped to.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        labels : dict
+            The labels of the stage.
+
+        Returns
+        -------
+        path : str
+            The `.prof` file, numbered in the order the stages started, or
+            None without profiling.
+        """
+        if self.profile_dir is None:
+            return None
+        with self._lock:
+            self._profiles += 1
+            number = self._profiles
+        parts = [f"{number:05d}", name]
+        parts += [f"{key}-{value}" for key, value in labels.items()]
+        return os.path.join(self.profile_dir, "_".join(parts) + ".prof")
+
+    def emit(self, record):
+        """Add a record to the log.
+
+        Parameters
+        ----------
+        record : dict
+            The record of a stage, as measured by `stage` or `measure`. The
+            `rows_per_sec` are computed from the `rows` set by the caller.
+
+        """
+        rows, seconds = record.get("rows"), record["wall_seconds"]
+        record["rows_per_sec"] = rows / seconds if rows and seconds > 0 else None
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(line + "\n")
+
+
+def _start(profile_path):
+    """Helper function to start measuring a stage.
+
+    Parameters
+    ----------
+    profile_path : str
+        File to dump the profile to, or None without profiling.
+
+    Returns
+    -------
+    start : tuple
+        The wall time, the thread CPU time, the peak resident set size and
+        the profiler, or None.
+    """
+    profiler = None
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another stage is profiled in a concurrent thread, which newer
+            # Python versions do not allow
+            print(f"Not profiling {profile_path}: another stage is profiled.")
+            profiler = None
+    return (time.time(), time.perf_counter(), cpu_time(), peak_rss_mb(), profiler)
+
+
+def _finish(record, start, profile_path):
+    """Helper function to stop measuring a stage.
+
+    Parameters
+    ----------
+    record : dict
+        The record of the stage, updated in place.
+    start : tuple
+        The start of the stage, as returned by `_start`.
+    profile_path : str
+        File to dump the profile to, or None without profiling.
+
+    Returns
+    -------
+    record : dict
+        The record of the stage.
+    """
+    started, perf_counter, cpu_start, peak_start, profiler = start
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    record["profile"] = profile_path if profiler is not None else None
+    record["started"] = started
+    record["wall_seconds"] = time.perf_counter() - perf_counter
+    record["cpu_seconds"] = cpu_time() - cpu_start
+    record["peak_rss_mb"] = peak_rss_mb()
+    record["peak_rss_delta_mb"] = (
+        record["peak_rss_mb"] - peak_start if peak_start is not None else None
+    )
+    record["pid"] = os.getpid()
+    return record
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Code to find users that have been close to each other in time and space.
+
+This module contains a spatio-temporal join of trackpoints. The points are
+hashed into buckets of `max_seconds` in time and of a grid cell in space, and
+only points in neighbouring buckets are compared with an exact distance
+check. Two users are close when they have trackpoints at most `max_seconds`
+apart in time and at most `max_meters` apart in haversine distance.
+
+The spatial grid is laid over the points on the unit sphere, with cells the
+size of the chord of `max_meters`. This avoids the distortion of a grid over
+latitudes and longitudes near the poles and across the date line.
+
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from geo import haversine
+from geo import to_unit_vectors
+from geo import chord_length
+
+# Engines that can be used to find the close users of query 6
+ENGINES = ("dbscan", "grid")
+
+# Number of bits of each grid coordinate in a packed cell. A cell of 100
+# meters gives about 130000 cells along each axis of the unit sphere.
+CELL_BITS = 20
+
+
+def close_pairs(df, max_seconds=60, max_meters=100):
+    """Find the pairs of users that have been close to each other.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The trackpoints, with the columns `user_id`, `date_time`, `lat` and
+        `lon`.
+    max_seconds : int, optional
+        The maximum time between close trackpoints in seconds. Defaults to 60.
+    max_meters : float, optional
+        The maximum distance between close trackpoints in meters. Defaults to
+        100.
+
+    Returns
+    -------
+    pairs_df : Pandas DataFrame
+        The close users, as rows of `user_a` and `user_b` with `user_a` less
+        than `user_b`.
+    """
+    users, codes = np.unique(df["user_id"].values, return_inverse=True)
+    seconds = (
+        pd.to_datetime(df["date_time"]).values.astype("datetime64[s]").astype(np.int64)
+    )
+    lat = df["lat"].values.astype(float)
+    lon = df["lon"].values.astype(float)
+
+    # Hash the points into buckets. The grid coordinates are shifted to be
+    # positive, and packed into a single integer per cell.
+    xyz = np.floor(to_unit_vectors(lat, lon) / chord_length(max_meters))
+    xyz = xyz.astype(np.int64) - xyz.min(axis=0).astype(np.int64) + 1
+    cells = (xyz[:, 0] << 2 * CELL_BITS) | (xyz[:, 1] << CELL_BITS) | xyz[:, 2]
+    times = seconds // max_seconds
+
+    # Sort the points by bucket and user, so the points of a user in a bucket
+    # form a contiguous slice
+    order = np.lexsort((codes, cells, times))
+    seconds, lat, lon = seconds[order], lat[order], lon[order]
+    times, cells, codes = times[order], cells[order], codes[order]
+    starts = np.flatnonzero(
+        np.diff(times, prepend=-1)
+        | np.diff(cells, prepend=-1)
+        | np.diff(codes, prepend=-1)
+    )
+    bucket_users = pd.DataFrame(
+        {
+            "time": times[starts],
+            "cell": cells[starts],
+            "user": codes[starts],
+            "start": starts,
+            "end": np.append(starts[1:], len(order)),
+        }
+    )
+    bucket_users = _prune_time_buckets(bucket_users)
+
+    if len(bucket_users) == 0:
+        return pd.DataFrame([], columns=["user_a", "user_b"])
+
+    # Number the buckets, and index the time buckets, cells and buckets in
+    # hash tables, so that neighbouring buckets are looked up in constant time
+    times = bucket_users["time"].values
+    cells = bucket_users["cell"].values
+    time_index = pd.Index(np.unique(times))
+    cell_index = pd.Index(np.unique(cells))
+    buckets = time_index.get_indexer(times) * len(cell_index) + cell_index.get_indexer(
+        cells
+    )
+    bucket_index, bucket_first, bucket_count = np.unique(
+        buckets, return_index=True, return_counts=True
+    )
+    bucket_index = pd.Index(bucket_index)
+
+    # Candidate bucket pairs holding points of two different users
+    user = bucket_users["user"].values
+    time_ranks = {dt: time_index.get_indexer(times + dt) for dt in (-1, 0, 1)}
+    candidates_a, candidates_b = [], []
+    for dt, dx, dy, dz in _half_offsets():
+        cell_rank = cell_index.get_indexer(
+            cells + (dx << 2 * CELL_BITS) + (dy << CELL_BITS) + dz
+        )
+        a = np.flatnonzero((time_ranks[dt] >= 0) & (cell_rank >= 0))
+        neighbours = bucket_index.get_indexer(
+            time_ranks[dt][a] * len(cell_index) + cell_rank[a]
+        )
+        a = a[neighbours >= 0]
+        neighbours = neighbours[neighbours >= 0]
+        first, counts = bucket_first[neighbours], bucket_count[neighbours]
+        a = np.repeat(a, counts)
+        b = np.arange(counts.sum()) + np.repeat(first - np.cumsum(counts) + counts, counts)
+        if (dt, dx, dy, dz) == (0, 0, 0, 0):
+            keep = user[a] < user[b]
+        else:
+            keep = user[a] != user[b]
+        candidates_a.append(a[keep])
+        candidates_b.append(b[keep])
+    a = np.concatenate(candidates_a)
+    b = np.concatenate(candidates_b)
+    low = np.minimum(user[a], user[b])
+    high = np.maximum(user[a], user[b])
+    order = np.lexsort((high, low))
+    a, b, low, high = a[order], b[order], low[order], high[order]
+
+    # Exact check of the candidates, until one close point pair is found for
+    # every user pair
+    bucket_start = bucket_users["start"].values
+    bucket_end = bucket_users["end"].values
+    close = []
+    for i in range(len(a)):
+        if close and close[-1] == (low[i], high[i]):
+            continue
+        i_a = np.arange(bucket_start[a[i]], bucket_end[a[i]])[:, None]
+        i_b = np.arange(bucket_start[b[i]], bucket_end[b[i]])[None, :]
+        in_time = np.abs(seconds[i_a] - seconds[i_b]) <= max_seconds
+        i_a, i_b = np.broadcast_arrays(i_a, i_b)
+        i_a, i_b = i_a[in_time], i_b[in_time]
+        if np.any(haversine(lat[i_a], lon[i_a], lat[i_b], lon[i_b]) <= max_meters):
+            close.append((low[i], high[i]))
+    return pd.DataFrame(
+        [(users[low], users[high]) for low, high in close],
+        columns=["user_a", "user_b"],
+    )
+
+
+def _prune_time_buckets(bucket_users):
+    """Helper function to drop the time buckets no other user is close to.
+
+    A point can only be close to the points of another user if the time
+    bucket or one of its neighbours holds points of another user.
+
+    Parameters
+    ----------
+    bucket_users : Pandas DataFrame
+        The users in every bucket.
+
+    Returns
+    -------
+    bucket_users : Pandas DataFrame
+        The users in the buckets that may hold close points.
+    """
+    counts = bucket_users[["time", "user"]].drop_duplicates()["time"].value_counts()
+    neighbours = (
+        counts.add(counts.rename(lambda t: t + 1), fill_value=0)
+        .add(counts.rename(lambda t: t - 1), fill_value=0)
+        .reindex(bucket_users["time"].values)
+    )
+    return bucket_users.loc[neighbours.values > 1].reset_index(drop=True)
+
+
+def _half_offsets():
+    """Helper function to list the offsets to the neighbouring buckets.
+
+    Only one of each pair of opposite offsets is listed, together with the
+    zero offset, so that every pair of neighbouring buckets is joined once.
+
+    Returns
+    -------
+    offsets : list
+        The offsets in time, x, y and z.
+    """
+    return [
+        offset
+        for offset in itertools.product((-1, 0, 1), repeat=4)
+        if offset >= (0, 0, 0, 0)
+    ]
+
+
+def close_pairs_stream(chunks, max_seconds=60, max_meters=100):
+    """Find the pairs of users that have been close to each other in a stream.
+
+    The trackpoints must arrive in time order. Every chunk is joined together
+    with the trackpoints of the last `max_seconds` of the chunks before it, so
+    that only those trackpoints are kept in memory between chunks.
+
+    Parameters
+    ----------
+    chunks : iterator
+        The trackpoints in time order, as DataFrames with the columns
+        `user_id`, `date_time`, `lat` and `lon`.
+    max_seconds : int, optional
+        The maximum time between close trackpoints in seconds. Defaults to 60.
+    max_meters : float, optional
+        The maximum distance between close trackpoints in meters. Defaults to
+        100.
+
+    Returns
+    -------
+    pairs_df : Pandas DataFrame
+        The close users, as rows of `user_a` and `user_b` with `user_a` less
+        than `user_b`.
+    """
+    pairs = set()
+    carry = None
+    for chunk in chunks:
+        df = chunk if carry is None else pd.concat([carry, chunk], ignore_index=True)
+        if len(df) == 0:
+            continue
+        pairs_df = close_pairs(df, max_seconds=max_seconds, max_meters=max_meters)
+        pairs.update(zip(pairs_df["user_a"], pairs_df["user_b"]))
+
+        # Keep the trackpoints that can still be close to the next chunk
+        date_time = pd.to_datetime(df["date_time"])
+        carry = df.loc[
+            date_time >= date_time.iloc[-1] - pd.Timedelta(seconds=max_seconds)
+        ]
+    return pd.DataFrame(sorted(pairs), columns=["user_a", "user_b"])
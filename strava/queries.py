@@ -2,25 +2,197 @@
 """Code to perform queries on the `TDT4225ProjectGroup78` database.
 
 This module contains code that queries the `TDT4225ProjectGroup78` database, to
-answer the questions given in the assignment text. The results are then printed
-to the console.
+answer the questions given in the assignment text. The results are returned as
+Pandas DataFrames, and printed to the console by `database.query_database`.
+The query functions are registered by number in `QUERIES`.
 
 """
 
+import time
+import numpy as np
 import pandas as pd
-from haversine import haversine_vector, Unit
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text
+from sqlalchemy import bindparam
 from tabulate import tabulate
 from sklearn.cluster import DBSCAN
+from geo import EARTH_RADIUS
+from geo import bounding_box
+from geo import haversine
+from geo import path_distances
+from simplify import lod_error_sums
+from simplify import combine_lod_errors
+from proximity import close_pairs
+from proximity import close_pairs_stream
+from proximity import ENGINES
+from windows import WINDOW_ENGINES
+from backends import year
+from backends import month
+from backends import days_between
+from backends import seconds_between
+from windows import elevation_gain_by_user
+from windows import elevation_gain_by_user_stream
+from windows import invalid_activities_by_user
+from windows import invalid_activities_by_user_stream
+
+# Methods that can be used to find the trackpoints in an area. `spatial`
+# filters on the spatial index of the `location` column and refines in MySQL,
+# while `scan` reads the `lat` and `lon` columns of every trackpoint.
+LOOKUP_METHODS = ("spatial", "scan")
+
+
+def _trackpoint_source(storage="activity", lod=None):
+    """Helper function to get the table expression of the activity trackpoints.
+
+    With `trajectory` storage the trackpoints are joined through
+    `ActivityTrajectory`, so that every activity sees the trackpoints of its
+    trajectory under its own `activity_id`. The expression is aliased as
+    `TrackPoint`, so queries can use it in place of the `TrackPoint` table.
+
+    Parameters
+    ----------
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    lod : int, optional
+        Read the trackpoints of the simplified trajectories at this tolerance
+        in meters from the TrackPointLOD table, which has no `altitude`.
+        Defaults to the full resolution.
+
+    Returns
+    -------
+    source : str
+        The table expression.
+    """
+    if lod is not None:
+        return _lod_source(storage, lod)
+    if storage == "activity":
+        return "TrackPoint"
+    return """(
+                SELECT
+                  ActivityTrajectory.activity_id,
+                  TrackPoint.id,
+                  TrackPoint.lat,
+                  TrackPoint.lon,
+                  TrackPoint.altitude,
+                  TrackPoint.date_time
+                FROM
+                  ActivityTrajectory
+                  JOIN TrackPoint ON TrackPoint.trajectory_id = ActivityTrajectory.trajectory_id
+              ) AS TrackPoint"""
+
+
+def _lod_source(storage, lod):
+    """Helper function to get the table expression of a level of detail.
+
+    Parameters
+    ----------
+    storage : str
+        How the trackpoints are stored, one of `tables.STORAGES`.
+    lod : int
+        The tolerance of the level in meters.
+
+    Returns
+    -------
+    source : str
+        The table expression, aliased as `TrackPoint`.
+    """
+    if storage == "activity":
+        return f"""(
+                SELECT
+                  TrackPointLOD.activity_id,
+                  TrackPointLOD.id,
+                  TrackPointLOD.lat,
+                  TrackPointLOD.lon,
+                  TrackPointLOD.date_time
+                FROM
+                  TrackPointLOD
+                WHERE
+                  TrackPointLOD.tolerance = {int(lod)}
+              ) AS TrackPoint"""
+    return f"""(
+                SELECT
+                  ActivityTrajectory.activity_id,
+                  TrackPointLOD.id,
+                  TrackPointLOD.lat,
+                  TrackPointLOD.lon,
+                  TrackPointLOD.date_time
+                FROM
+                  ActivityTrajectory
+                  JOIN TrackPointLOD ON TrackPointLOD.trajectory_id = ActivityTrajectory.trajectory_id
+                WHERE
+                  TrackPointLOD.tolerance = {int(lod)}
+              ) AS TrackPoint"""
+
+
+def read_sql_chunks(cnx, query, chunksize, parse_dates=None):
+    """Read the rows of a query in chunks.
+
+    The rows are read through an unbuffered server-side cursor (pymysql's
+    `SSCursor`), so neither the driver nor Pandas holds more than a chunk of
+    rows at a time. The connection can not run other queries until all chunks
+    are read.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    query : str
+        The SQL query.
+    chunksize : int
+        The number of rows per chunk.
+    parse_dates : list, optional
+        The columns to parse as datetimes. Defaults to none.
+
+    Returns
+    -------
+    chunks : iterator
+        The rows as Pandas DataFrames of at most `chunksize` rows.
+    """
+    stream_cnx = cnx.execution_options(stream_results=True)
+    return pd.read_sql_query(
+        query, con=stream_cnx, chunksize=chunksize, parse_dates=parse_dates
+    )
+
+
+def explain(cnx, query):
+    """Print the execution plan of a query.
+
+    The `partitions` column lists the partitions of each table that are read,
+    which shows whether the date predicates prune the partitions of a
+    partitioned TrackPoint table.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    query : str
+        The SQL query.
+
+    Returns
+    -------
+    plan_df : Pandas DataFrame
+        The rows of the `EXPLAIN` output.
+    """
+    prefix = "EXPLAIN QUERY PLAN" if cnx.dialect.name == "sqlite" else "EXPLAIN"
+    plan_df = pd.read_sql_query(f"{prefix} {query}", con=cnx)
+    print(tabulate(plan_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return plan_df
 
 
 def query_1(cnx):
     """Find answers to query 1 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query_a = """
               SELECT
@@ -44,17 +216,22 @@ def query_1(cnx):
     query_df = pd.read_sql_query(query_a, con=cnx)
     query_df = pd.concat([query_df, pd.read_sql_query(query_b, con=cnx)], axis=1)
     query_df = pd.concat([query_df, pd.read_sql_query(query_c, con=cnx)], axis=1)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_2(cnx):
     """Find answers to query 2 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query = """
             SELECT
@@ -76,17 +253,22 @@ def query_2(cnx):
               ) AS T1
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_3(cnx):
     """Find answers to query 3 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query = """
             SELECT
@@ -103,19 +285,25 @@ def query_3(cnx):
             """
     query_df = pd.read_sql_query(query, con=cnx)
     query_df = query_df.rename(columns={"user_activities": "Number of Activities"})
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_4(cnx):
     """Find answers to query 4 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
-    query = """
+    dialect = cnx.dialect.name
+    query = f"""
             SELECT
               COUNT(
                 DISTINCT(user_id)
@@ -123,20 +311,25 @@ def query_4(cnx):
             FROM
               Activity
             WHERE
-              DATEDIFF(end_date_time, start_date_time) = 1
+              {days_between(dialect, "start_date_time", "end_date_time")} = 1
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_5(cnx):
     """Find answers to query 5 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query = """
             SELECT
@@ -158,83 +351,236 @@ def query_5(cnx):
               AND COUNT(end_date_time) > 1
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
-def query_6(cnx):
+def query_6(cnx, storage="activity", engine="dbscan", workers=1, chunksize=None):
     """Find answers to query 6 by SQL queries. Use DBSCAN to first cluster on users
     close in time. Then use DBSCAN again to cluster the results on users that
     are close in space.
 
+    With the `grid` engine the trackpoints are instead joined on buckets of 60
+    seconds and 100 meters, see `proximity.close_pairs`, which finds every
+    pair of users with trackpoints within 60 seconds and 100 meters of each
+    other in close to linear time.
+
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    engine : str, optional
+        The engine used to find the close users, one of `proximity.ENGINES`.
+        Defaults to `dbscan`.
+    workers : int, optional
+        The number of processes used to cluster the time clusters on distance
+        with the `dbscan` engine, see `close_user_sets`. Defaults to 1.
+    chunksize : int, optional
+        Stream the trackpoints in time order, in chunks of this many rows,
+        see `read_sql_chunks`. Defaults to reading all trackpoints at once.
 
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
-    query = """
+    query = f"""
             SELECT
               Activity.user_id,
               TrackPoint.activity_id,
               TrackPoint.id AS trackpoint_id,
               lat,
               lon,
-              date_days
+              date_time
             FROM
               Activity
-              RIGHT JOIN TrackPoint ON TrackPoint.activity_id = activity.id
+              RIGHT JOIN {_trackpoint_source(storage)} ON TrackPoint.activity_id = activity.id
             """
-    query_df = pd.read_sql_query(query, con=cnx)
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    if chunksize is not None:
+        chunks = read_sql_chunks(
+            cnx,
+            query + " ORDER BY TrackPoint.date_time",
+            chunksize,
+            parse_dates=["date_time"],
+        )
+        if engine == "grid":
+            pairs_df = close_pairs_stream(chunks, max_seconds=60, max_meters=100)
+        else:
+            close_users = close_user_sets_stream(chunks, workers=workers)
+    else:
+        query_df = pd.read_sql_query(query, con=cnx, parse_dates=["date_time"])
+        if engine == "grid":
+            pairs_df = close_pairs(query_df, max_seconds=60, max_meters=100)
+        else:
+            close_users = close_user_sets(query_df, workers=workers)
+
+    if engine == "grid":
+        close_users = set(pairs_df["user_a"]) | set(pairs_df["user_b"])
+        return pd.DataFrame(
+            {
+                "number_of_close_users": [len(close_users)],
+                "number_of_close_user_pairs": [len(pairs_df)],
+            }
+        )
+    # Find total number of users that have been close
+    number_of_close_users = len([user for s in close_users for user in s])
+    return pd.DataFrame({"number_of_close_users": [number_of_close_users]})
+
+
+def close_user_sets_stream(chunks, workers=1):
+    """Find the sets of users that have been close to each other in a stream.
+
+    The trackpoints must arrive in time order. As the time clusters are runs
+    of trackpoints less than 60 seconds apart, every gap of more than 60
+    seconds closes the time clusters before it. The closed clusters are
+    clustered with `close_user_sets` right away, and only the trackpoints of
+    the open time cluster are kept in memory between chunks.
+
+    Parameters
+    ----------
+    chunks : iterator
+        The trackpoints in time order, as DataFrames with the columns
+        `user_id`, `activity_id`, `lat`, `lon` and `date_time`.
+    workers : int, optional
+        The number of processes used to cluster on distance. Defaults to 1.
+
+    Returns
+    -------
+    close_users : set
+        The frozensets of users that have been close to each other.
+    """
+    close_users = set()
+    pending = None
+    for chunk in chunks:
+        df = chunk if pending is None else pd.concat([pending, chunk], ignore_index=True)
+        if len(df) == 0:
+            continue
+        seconds = pd.to_datetime(df["date_time"]).values.astype("datetime64[s]")
+        gaps = np.flatnonzero(np.diff(seconds.astype(np.int64)) > 60)
+        if len(gaps) == 0:
+            pending = df
+            continue
+        close_users |= close_user_sets(df.iloc[: gaps[-1] + 1], workers=workers)
+        pending = df.iloc[gaps[-1] + 1 :]
+    if pending is not None and len(pending) > 0:
+        close_users |= close_user_sets(pending, workers=workers)
+    return close_users
+
+
+def close_user_sets(query_df, workers=1):
+    """Find the sets of users that have been close to each other with DBSCAN.
 
+    The trackpoints are first clustered on time. The time clusters are then
+    sorted and sliced once, and each slice is clustered on distance, in a
+    pool of `workers` processes if more than one.
+
+    Parameters
+    ----------
+    query_df : Pandas DataFrame
+        The trackpoints, with the columns `user_id`, `activity_id`, `lat`,
+        `lon` and `date_time`.
+    workers : int, optional
+        The number of processes used to cluster on distance. Defaults to 1.
+
+    Returns
+    -------
+    close_users : set
+        The frozensets of users that have been close to each other.
+    """
     # Use DBSCAN to cluster on time
     X = (
-        (query_df["date_days"] - query_df["date_days"].min()) * 24 * 60 * 60
+        (query_df["date_time"] - query_df["date_time"].min()).dt.total_seconds()
     ).values.reshape(-1, 1)
     eps = 60  # seconds
     min_samples = 2
     cluster = DBSCAN(eps=eps, min_samples=min_samples).fit(X)
-    query_df["time_labels"] = cluster.labels_
+    query_df = query_df.assign(time_labels=cluster.labels_)
     query_df = query_df.loc[query_df["time_labels"] != -1]
 
-    # Use DBSCAN again to cluster on distance using the haversine distance
-    close_users = []
-    for tl in query_df["time_labels"].unique():
-        df = query_df.loc[
-            query_df["time_labels"] == tl, ["user_id", "activity_id", "lat", "lon"]
-        ]
-        X = df[["lat", "lon"]].values
-        eps = 100  # meters
-        # divide by earth radius https://en.wikipedia.org/wiki/Earth_radius#Arithmetic_mean_radius
-        eps = eps / 6371008.8
-        min_samples = 2
-        cluster = DBSCAN(eps=eps, min_samples=min_samples, metric="haversine").fit(X)
-        df["spatial_labels"] = cluster.labels_
-        df = df.loc[df["spatial_labels"] != -1]
-        # Get sets of users that are close to each other
-        df = df.groupby(["spatial_labels"]).agg(
-            user_id=pd.NamedAgg(column="user_id", aggfunc=frozenset)
+    # Slice the time clusters out of the trackpoints sorted on the cluster
+    query_df = query_df.sort_values("time_labels", kind="stable")
+    labels = query_df["time_labels"].values
+    bounds = np.flatnonzero(np.diff(labels)) + 1
+    query_df = query_df[["user_id", "activity_id", "lat", "lon"]]
+    slices = [
+        query_df.iloc[start:end]
+        for start, end in zip(
+            np.append(0, bounds), np.append(bounds, len(query_df))
         )
-        df = df.loc[
-            df["user_id"].map(len) > 1
-        ]  # must have minimum two users per spatial cluster
-        # Only append unique sets for current iteration
-        close_users.append(df["user_id"].unique())
+        if end > start
+    ]
+
+    # Use DBSCAN again to cluster on distance using the haversine distance
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            close_users = list(
+                executor.map(
+                    _spatial_clusters,
+                    slices,
+                    chunksize=max(1, len(slices) // (4 * workers)),
+                )
+            )
+    else:
+        close_users = [_spatial_clusters(df) for df in slices]
 
     # Find all unique sets close users and remove empty arrays
-    close_users = {s for arr in close_users if arr.size > 1 for s in arr}
-    # Find total number of users that have been close
-    number_of_close_users = len([user for s in close_users for user in s])
-    print(f"Number of close users: {number_of_close_users}")
+    return {s for arr in close_users if arr.size > 1 for s in arr}
+
+
+def _spatial_clusters(df):
+    """Helper function to cluster the trackpoints of a time cluster on distance.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The trackpoints of the time cluster.
+
+    Returns
+    -------
+    close_users : ndarray
+        The unique frozensets of users in the same spatial cluster.
+    """
+    # A time cluster of a single user has no close users
+    if df["user_id"].nunique() < 2:
+        return np.array([], dtype=object)
+
+    X = df[["lat", "lon"]].values
+    eps = 100  # meters
+    # divide by earth radius https://en.wikipedia.org/wiki/Earth_radius#Arithmetic_mean_radius
+    eps = eps / EARTH_RADIUS
+    min_samples = 2
+    cluster = DBSCAN(eps=eps, min_samples=min_samples, metric="haversine").fit(X)
+    df = df.assign(spatial_labels=cluster.labels_)
+    df = df.loc[df["spatial_labels"] != -1]
+    # Get sets of users that are close to each other
+    df = df.groupby(["spatial_labels"]).agg(
+        user_id=pd.NamedAgg(column="user_id", aggfunc=frozenset)
+    )
+    df = df.loc[
+        df["user_id"].map(len) > 1
+    ]  # must have minimum two users per spatial cluster
+    # Only append unique sets for current iteration
+    return df["user_id"].unique()
 
 
 def query_7(cnx):
     """Find answers to query 7 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query = """
             SELECT
@@ -255,17 +601,22 @@ def query_7(cnx):
     values = query_df.values.reshape((-1, 4), order='F')
     cols = ['user_id'] * 4
     query_df = pd.DataFrame(data=values, columns=cols)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_8(cnx):
     """Find answers to query 8 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
     query = """
             SELECT
@@ -281,128 +632,368 @@ def query_8(cnx):
               transportation_mode
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
 def query_9(cnx):
-    """Find answers to query 9 by SQL queries. Use Pandas DataFrames to manipulate
-    the data in order to find the relevant results.
+    """Find answers to query 9 by SQL queries. The activities are counted and
+    their hours summed per user and month in SQL, and Pandas DataFrames are
+    used to find the relevant results in the aggregated rows.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
 
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
-    query = """
+    dialect = cnx.dialect.name
+    query = f"""
             SELECT
-              *
+              {year(dialect, "start_date_time")} AS year,
+              {month(dialect, "start_date_time")} AS month,
+              user_id,
+              COUNT(*) AS number_of_activities,
+              SUM(
+                {seconds_between(dialect, "start_date_time", "end_date_time")}
+              ) / 3600.0 AS recorded_hours,
+              SUM(
+                CASE
+                  WHEN {month(dialect, "end_date_time")} <> {month(dialect, "start_date_time")}
+                  THEN 1
+                  ELSE 0
+                END
+              ) AS month_changes
             FROM
               Activity
+            GROUP BY
+              year,
+              month,
+              user_id
             """
     query_df = pd.read_sql_query(query, con=cnx)
 
     # Create relevant time columns
-    query_df["month_diff"] = query_df["end_date_time"].apply(
-        lambda x: x.month
-    ) - query_df["start_date_time"].apply(lambda x: x.month)
     query_df["year_month"] = (
-        query_df["start_date_time"].apply(lambda x: x.year).astype(str)
+        query_df["year"].astype(str)
         + "-"
-        + query_df["start_date_time"].apply(lambda x: x.month_name())
+        + pd.to_datetime(
+            query_df[["year", "month"]].assign(day=1)
+        ).dt.month_name()
     )
-    query_df["recorded_hours"] = (
-        query_df["end_date_time"] - query_df["start_date_time"]
-    ).apply(lambda x: x.total_seconds() / 3600)
 
     # Find most active year-month
     year_month_ma = (
-        query_df.groupby(["year_month"])
-        .count()
-        .sort_values(by="id", ascending=False)
+        query_df.groupby(["year_month"])["number_of_activities"]
+        .sum()
+        .sort_values(ascending=False)
         .index[0]
     )
     # Find most active and second most active user in most active year-month
-    ma_df = (
-        query_df.loc[query_df["year_month"] == year_month_ma]
-        .groupby(["user_id"])
-        .count()
-        .sort_values(by="id", ascending=False)
-    )
-    user_ma_1 = ma_df.index[0]
-    num_act_1 = ma_df["id"][0]
-    user_ma_2 = ma_df.index[1]
-    num_act_2 = ma_df["id"][1]
+    query_df = query_df.loc[query_df["year_month"] == year_month_ma]
+    ma_df = query_df.sort_values(by="number_of_activities", ascending=False)
+    user_ma_1, user_ma_2 = ma_df["user_id"].iloc[:2]
 
     # Select subset of data for most active and second most active user in
     # most active year-month
-    query_df = query_df.loc[
-        (query_df["year_month"] == year_month_ma)
-        & (query_df["user_id"].isin([user_ma_1, user_ma_2]))
-    ]
+    query_df = query_df.loc[query_df["user_id"].isin([user_ma_1, user_ma_2])]
 
     # Assert that these users did not record any activities that started in
     # one month and ended in another
-    assert all(query_df["month_diff"] == 0)
+    assert all(query_df["month_changes"] == 0)
 
     # Create dataframe for number of activities and number of hours logged
-    result_df = (
-        query_df.groupby(["user_id"])
-        .agg(recorded_hours=pd.NamedAgg(column="recorded_hours", aggfunc=sum))
-        .reset_index()
-    )
-    d = {user_ma_1: num_act_1, user_ma_2: num_act_2}
-    result_df["number_of_activities"] = result_df["user_id"].map(d)
-    result_df["year_month"] = year_month_ma
-    print(tabulate(result_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    result_df = query_df.sort_values(by="user_id")[
+        ["user_id", "recorded_hours", "number_of_activities", "year_month"]
+    ].astype({"recorded_hours": float, "number_of_activities": int})
+    return result_df
+
+
+def query_10_sql(storage="activity", lod=None):
+    """Get the SQL query of query 10.
+
+    The year is filtered with a half-open range on `date_time` rather than
+    with `YEAR(date_time)`, so that MySQL can prune the partitions of a
+    partitioned TrackPoint table, and use an index on `date_time`.
+
+    Parameters
+    ----------
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    lod : int, optional
+        The tolerance in meters of the simplified trajectories to read.
+        Defaults to the full resolution.
+
+    Returns
+    -------
+    query : str
+        The SQL query.
+    """
+    return f"""
+            SELECT
+              TrackPoint.activity_id,
+              TrackPoint.lat,
+              TrackPoint.lon
+            FROM
+              Activity
+              RIGHT JOIN {_trackpoint_source(storage, lod)} ON TrackPoint.activity_id = Activity.id
+            WHERE
+              Activity.transportation_mode = 'walk'
+              AND Activity.user_id = '112'
+              AND TrackPoint.date_time >= '2008-01-01'
+              AND TrackPoint.date_time < '2009-01-01'
+            """
+
 
+def query_10(cnx, storage="activity", stats=False, chunksize=None, lod=None):
+    """Find answers to query 10 by SQL queries. Sum the distance of all
+    activities in one pass with `geo.path_distances`.
 
-def query_10(cnx):
-    """Find answers to query 10 by SQL queries. Use Pandas DataFrames to sum the
-    distance using the haversine Python package.
+    With `stats`, the distance of the activities that lie within 2008 is read
+    from the ActivityStats table, and only the trackpoints of the activities
+    that cross into or out of 2008 are read.
+
+    With `lod`, the trackpoints of the simplified trajectories are read,
+    which gives a shorter distance, see `lod_report`. The ActivityStats table
+    holds the distances at full resolution, so `lod` is ignored with `stats`.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    stats : bool, optional
+        Use the ActivityStats table. Defaults to False.
+    chunksize : int, optional
+        Without `stats`, stream the trackpoints in chunks of this many rows,
+        see `stream_path_distance`. Defaults to reading all trackpoints at
+        once.
+    lod : int, optional
+        Without `stats`, the tolerance in meters of the simplified
+        trajectories to read. Defaults to the full resolution.
 
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
+    if not stats and chunksize is not None:
+        query = query_10_sql(storage, lod) + " ORDER BY TrackPoint.activity_id, TrackPoint.id"
+        distance_walked = stream_path_distance(
+            read_sql_chunks(cnx, query, chunksize), by="activity_id"
+        )
+        distance_walked = distance_walked / 1000  # kilometers
+        return pd.DataFrame({"total_distance_walked": [distance_walked]})
+    if not stats:
+        query_df = pd.read_sql_query(query_10_sql(storage, lod), con=cnx)
+        _, distance_walked = path_distances(query_df, by="activity_id")
+        distance_walked = distance_walked / 1000  # kilometers
+        return pd.DataFrame({"total_distance_walked": [distance_walked]})
+
     query = """
+            SELECT
+              COALESCE(SUM(ActivityStats.distance), 0) AS distance
+            FROM
+              Activity
+              JOIN ActivityStats ON ActivityStats.activity_id = Activity.id
+            WHERE
+              Activity.transportation_mode = 'walk'
+              AND Activity.user_id = '112'
+              AND Activity.start_date_time >= '2008-01-01'
+              AND Activity.end_date_time < '2009-01-01'
+            """
+    distance_walked = pd.read_sql_query(query, con=cnx)["distance"].iloc[0]
+    query = f"""
             SELECT
               TrackPoint.activity_id,
               TrackPoint.lat,
               TrackPoint.lon
             FROM
               Activity
-              RIGHT JOIN TrackPoint ON TrackPoint.activity_id = Activity.id
+              JOIN {_trackpoint_source(storage)} ON TrackPoint.activity_id = Activity.id
             WHERE
               Activity.transportation_mode = 'walk'
               AND Activity.user_id = '112'
-              AND YEAR(TrackPoint.date_time) = 2008
+              AND Activity.start_date_time < '2009-01-01'
+              AND Activity.end_date_time >= '2008-01-01'
+              AND NOT (
+                Activity.start_date_time >= '2008-01-01'
+                AND Activity.end_date_time < '2009-01-01'
+              )
+              AND TrackPoint.date_time >= '2008-01-01'
+              AND TrackPoint.date_time < '2009-01-01'
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    distance_walked = 0
-    for aid in query_df["activity_id"].unique():
-        df = query_df.loc[query_df["activity_id"] == aid].copy()
-        df["dist"] = haversine_vector(
-            df[["lat", "lon"]].values,
-            df[["lat", "lon"]].shift().values,
-            Unit.KILOMETERS,
+    distance_walked += path_distances(query_df, by="activity_id")[1]
+    distance_walked = distance_walked / 1000  # kilometers
+    return pd.DataFrame({"total_distance_walked": [distance_walked]})
+
+
+def stream_path_distance(chunks, by="activity_id"):
+    """Compute the total length of the paths through streamed trackpoints.
+
+    The trackpoints must arrive ordered by path. The last trackpoint of every
+    chunk is carried over to the next chunk, so that the step across the
+    boundary between two chunks is counted when they split a path.
+
+    Parameters
+    ----------
+    chunks : iterator
+        The trackpoints ordered by path, as DataFrames with the columns `lat`,
+        `lon` and `by`.
+    by : str, optional
+        The column identifying the path of a trackpoint. Defaults to
+        `activity_id`.
+
+    Returns
+    -------
+    total : float
+        The total length of the paths in meters.
+    """
+    total = 0.0
+    carry = None
+    for chunk in chunks:
+        df = chunk if carry is None else pd.concat([carry, chunk], ignore_index=True)
+        if len(df) == 0:
+            continue
+        total += path_distances(df, by=by)[1]
+        carry = df.iloc[-1:]
+    return total
+
+
+def read_window_columns(cnx, storage="activity", column="altitude", chunksize=None):
+    """Read the columns needed to answer queries 11 and 12 with NumPy.
+
+    The tables are scanned in primary key order, without window functions or
+    sorting on the server. Streamed trackpoints are ordered by activity and
+    id instead, so that consecutive trackpoints of an activity are read in
+    order.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    column : str, optional
+        The trackpoint column to read. Defaults to `altitude`.
+    chunksize : int, optional
+        Stream the trackpoints in chunks of this many rows, see
+        `read_sql_chunks`. Defaults to reading all trackpoints at once.
+
+    Returns
+    -------
+    activity_df : Pandas DataFrame
+        The `user_id` of every activity, and its `activity_id`, or with
+        `trajectory` storage its `trajectory_id`.
+    trackpoint_df : Pandas DataFrame or iterator
+        The `id`, the `activity_id` or `trajectory_id`, and `column` of every
+        trackpoint, or with `chunksize` the chunks of them.
+    by : str
+        The column identifying the activity of a trackpoint.
+    """
+    if storage == "activity":
+        by = "activity_id"
+        activity_query = "SELECT id AS activity_id, user_id FROM Activity"
+    else:
+        by = "trajectory_id"
+        activity_query = """
+            SELECT
+              ActivityTrajectory.trajectory_id,
+              Activity.user_id
+            FROM
+              Activity
+              JOIN ActivityTrajectory ON ActivityTrajectory.activity_id = Activity.id
+            """
+    activity_df = pd.read_sql_query(activity_query, con=cnx)
+    query = f"SELECT id, {by}, {column} FROM TrackPoint"
+    if chunksize is not None:
+        parse_dates = ["date_time"] if column == "date_time" else None
+        trackpoint_df = read_sql_chunks(
+            cnx, query + f" ORDER BY {by}, id", chunksize, parse_dates=parse_dates
         )
-        distance_walked += df["dist"].sum()
-    print(f"Total distance walked: {distance_walked}")
+    else:
+        trackpoint_df = pd.read_sql_query(query, con=cnx)
+    return (activity_df, trackpoint_df, by)
 
 
-def query_11(cnx):
+def query_11(
+    cnx, storage="activity", stats=False, window_engine="sql", chunksize=None
+):
     """Find answers to query 11 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
+
+    With the `numpy` window engine the altitude differences are computed from
+    the trackpoint columns, see `windows.elevation_gain_by_user`, instead of
+    with a window function in MySQL.
+
+    With `activity` storage, the trackpoints of a file matching several labels
+    are stored once per label, all under the last activity of the file. The
+    window over that activity then also counts the climb from the last
+    trackpoint of one copy to the first trackpoint of the next. The
+    ActivityStats table, and `trajectory` storage, count every copy on its
+    own, so their answers can be slightly lower for users with such files.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    stats : bool, optional
+        Sum the elevation gain of the ActivityStats table. Defaults to False.
+    window_engine : str, optional
+        The engine used without `stats`, one of `windows.WINDOW_ENGINES`.
+        Defaults to `sql`.
+    chunksize : int, optional
+        With the `numpy` window engine, stream the trackpoints in chunks of
+        this many rows, see `read_window_columns`. Defaults to reading all
+        trackpoints at once.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
-    query = """
+    if stats:
+        query = """
+            SELECT
+              user_id,
+              SUM(elevation_gain) AS total_elevation_gain
+            FROM
+              Activity
+              JOIN ActivityStats ON ActivityStats.activity_id = Activity.id
+            GROUP BY
+              user_id
+            HAVING
+              total_elevation_gain > 0
+            ORDER BY
+              total_elevation_gain DESC
+            LIMIT
+              20;
+            """
+        query_df = pd.read_sql_query(query, con=cnx)
+        return query_df
+
+    if window_engine not in WINDOW_ENGINES:
+        raise ValueError(f"Unknown window engine: {window_engine}")
+    if window_engine == "numpy":
+        activity_df, trackpoint_df, by = read_window_columns(
+            cnx, storage, "altitude", chunksize
+        )
+        if chunksize is not None:
+            return elevation_gain_by_user_stream(activity_df, trackpoint_df, by=by)
+        return elevation_gain_by_user(activity_df, trackpoint_df, by=by)
+
+    query = f"""
             SELECT
               user_id,
               SUM(altitude_diff) AS total_elevation_gain
@@ -427,7 +1018,7 @@ def query_11(cnx):
                       altitude
                     FROM
                       activity
-                      RIGHT JOIN TrackPoint ON Activity.id = TrackPoint.activity_id
+                      RIGHT JOIN {_trackpoint_source(storage)} ON Activity.id = TrackPoint.activity_id
                   ) AS T1
                 ORDER BY
                   trackpoint_id ASC
@@ -442,19 +1033,83 @@ def query_11(cnx):
               20;
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
 
 
-def query_12(cnx):
+def query_12(
+    cnx, storage="activity", stats=False, window_engine="sql", chunksize=None
+):
     """Find answers to query 12 by SQL queries. Results are places in single Pandas
-    DataFrame, and printed.
+    DataFrame, and returned.
+
+    The time between consecutive trackpoints is measured in seconds, see
+    `backends.seconds_between`. MySQL subtracts two DATETIMEs as
+    YYYYMMDDhhmmss numbers, so `date_time - LAG(date_time) > 300` would flag
+    gaps of 3 minutes, and every change of the hour or the date. The `numpy`
+    window engine and the `max_gap` of the ActivityStats table are in seconds
+    as well.
+
+    With the `numpy` window engine the time differences are computed from the
+    trackpoint columns, see `windows.invalid_activities_by_user`, instead of
+    with a window function in MySQL.
 
     Parameters
     ----------
     cnx : :obj:
         The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    stats : bool, optional
+        Use the largest time gap of the ActivityStats table. Defaults to
+        False.
+    window_engine : str, optional
+        The engine used without `stats`, one of `windows.WINDOW_ENGINES`.
+        Defaults to `sql`.
+    chunksize : int, optional
+        With the `numpy` window engine, stream the trackpoints in chunks of
+        this many rows, see `read_window_columns`. Defaults to reading all
+        trackpoints at once.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The results of the query.
     """
-    query = """
+    if stats:
+        query = """
+            SELECT
+              user_id,
+              COUNT(*) AS number_of_invalid_activities
+            FROM
+              Activity
+              JOIN ActivityStats ON ActivityStats.activity_id = Activity.id
+            WHERE
+              max_gap > 300
+            GROUP BY
+              user_id
+            ORDER BY
+              number_of_invalid_activities DESC
+            """
+        query_df = pd.read_sql_query(query, con=cnx)
+        return query_df
+
+    if window_engine not in WINDOW_ENGINES:
+        raise ValueError(f"Unknown window engine: {window_engine}")
+    if window_engine == "numpy":
+        activity_df, trackpoint_df, by = read_window_columns(
+            cnx, storage, "date_time", chunksize
+        )
+        if chunksize is not None:
+            return invalid_activities_by_user_stream(activity_df, trackpoint_df, by=by)
+        return invalid_activities_by_user(activity_df, trackpoint_df, by=by)
+
+    lag_date_time = """LAG(date_time) OVER (
+                      PARTITION BY activity_id
+                      ORDER BY
+                        trackpoint_id ASC
+                    )"""
+    query = f"""
             SELECT
               user_id,
               COUNT(
@@ -467,11 +1122,7 @@ def query_12(cnx):
                   activity_id,
                   user_id,
                   date_time,
-                  date_time - LAG(date_time) OVER (
-                    PARTITION BY activity_id
-                    ORDER BY
-                      trackpoint_id ASC
-                  ) AS date_time_diff_seconds
+                  {seconds_between(cnx.dialect.name, lag_date_time, "date_time")} AS date_time_diff_seconds
                 FROM
                   (
                     SELECT
@@ -481,7 +1132,7 @@ def query_12(cnx):
                       date_time
                     FROM
                       Activity
-                      RIGHT JOIN TrackPoint ON Activity.id = TrackPoint.activity_id
+                      RIGHT JOIN {_trackpoint_source(storage)} ON Activity.id = TrackPoint.activity_id
                   ) AS T1
                 ORDER BY
                   trackpoint_id ASC
@@ -494,4 +1145,603 @@ def query_12(cnx):
               number_of_invalid_activities DESC
             """
     query_df = pd.read_sql_query(query, con=cnx)
-    print(tabulate(query_df, headers="keys", showindex=False, tablefmt="orgtbl"))
+    return query_df
+
+
+def check_window_engines(cnx, storage="activity", chunksize=None):
+    """Check that both window engines give the same answers to queries 11 and 12.
+
+    Ties are ordered by user, as their order is not defined by the SQL
+    queries.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    chunksize : int, optional
+        Stream the trackpoints of the `numpy` engine in chunks of this many
+        rows. Defaults to reading all trackpoints at once.
+
+    Returns
+    -------
+    same : dict
+        True for every query where the answers of the engines are the same.
+    """
+    same = {}
+    for number, query in ((11, query_11), (12, query_12)):
+        answers = []
+        for window_engine in WINDOW_ENGINES:
+            query_df = query(
+                cnx, storage=storage, window_engine=window_engine, chunksize=chunksize
+            )
+            column = query_df.columns[1]
+            query_df = query_df.astype({"user_id": str, column: float})
+            answers.append(
+                query_df.sort_values(
+                    [column, "user_id"], ascending=[False, True]
+                ).reset_index(drop=True)
+            )
+        same[number] = len(answers[0]) == len(answers[1]) and bool(
+            (answers[0]["user_id"] == answers[1]["user_id"]).all()
+            and np.allclose(answers[0].iloc[:, 1], answers[1].iloc[:, 1])
+        )
+        print(f"Query {number}: same answer with both window engines: {same[number]}")
+    return same
+
+
+def _envelope(min_lat, min_lon, max_lat, max_lon):
+    """Helper function to get the polygon filtering on the spatial index.
+
+    The edges of a polygon in SRID 4326 are geodesics, which bend poleward of
+    the parallels between the corners, so the latitudes are widened by the
+    largest such bend. The points of the polygon outside the box are removed
+    by the exact refinement.
+
+    Parameters
+    ----------
+    min_lat, min_lon, max_lat, max_lon : float
+        The box in degrees.
+
+    Returns
+    -------
+    wkt : str
+        The polygon as well-known text, in latitude-longitude order.
+    """
+    width = np.radians(max_lon - min_lon)
+    bend = np.degrees(width ** 2 / 8) + 1e-6
+    min_lat, max_lat = max(min_lat - bend, -90.0), min(max_lat + bend, 90.0)
+    corners = [
+        (min_lat, min_lon),
+        (min_lat, max_lon),
+        (max_lat, max_lon),
+        (max_lat, min_lon),
+        (min_lat, min_lon),
+    ]
+    return "POLYGON(({}))".format(", ".join(f"{lat!r} {lon!r}" for lat, lon in corners))
+
+
+def _lookup_sql(storage, method, radius=False):
+    """Helper function to get the SQL query finding the trackpoints in an area.
+
+    Parameters
+    ----------
+    storage : str
+        How the trackpoints are stored, one of `tables.STORAGES`.
+    method : str
+        One of `LOOKUP_METHODS`.
+    radius : bool, optional
+        Refine on the distance to a center with `ST_Distance_Sphere`, with the
+        `spatial` method. Defaults to False.
+
+    Returns
+    -------
+    query : str
+        The SQL query, with the parameters `min_lat`, `min_lon`, `max_lat` and
+        `max_lon`, and `envelope`, `lat`, `lon` and `radius` with the
+        `spatial` method.
+    """
+    key = "activity_id" if storage == "activity" else "trajectory_id"
+    columns = ["id", key, "lat", "lon", "date_time"]
+    conditions = [
+        "TrackPoint.lat BETWEEN :min_lat AND :max_lat",
+        "TrackPoint.lon BETWEEN :min_lon AND :max_lon",
+    ]
+    if method == "spatial":
+        # The spatial index is only used for the MBR filter
+        conditions.insert(
+            0, "MBRContains(ST_GeomFromText(:envelope, 4326), TrackPoint.location)"
+        )
+        if radius:
+            distance = (
+                "ST_Distance_Sphere("
+                "TrackPoint.location, ST_SRID(POINT(:lat, :lon), 4326), "
+                f"{EARTH_RADIUS})"
+            )
+            columns.append(f"{distance} AS distance")
+            conditions.append(f"{distance} <= :radius")
+    columns = ",\n              ".join(
+        column if "(" in column else f"TrackPoint.{column}" for column in columns
+    )
+    conditions = "\n              AND ".join(conditions)
+    return f"""
+            SELECT
+              {columns}
+            FROM
+              TrackPoint
+            WHERE
+              {conditions}
+            """
+
+
+def _check_lookup(cnx, method):
+    """Helper function to check that a lookup method can be used.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    method : str
+        One of `LOOKUP_METHODS`.
+
+    """
+    if method not in LOOKUP_METHODS:
+        raise ValueError(f"Unknown lookup method: {method}")
+    if method == "spatial" and cnx.dialect.name != "mysql":
+        raise ValueError("The spatial lookup method needs the mysql backend")
+
+
+def trackpoints_in_bbox(
+    cnx, min_lat, min_lon, max_lat, max_lon, storage="activity", method="spatial"
+):
+    """Find the trackpoints in a latitude and longitude box.
+
+    With the `spatial` method the trackpoints are filtered on the spatial
+    index of the `location` column, see `tables.get_tables`, and the box is
+    checked exactly on `lat` and `lon`. With the `scan` method every
+    trackpoint is read.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    min_lat, min_lon, max_lat, max_lon : float
+        The box in degrees, including its edges.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    method : str, optional
+        One of `LOOKUP_METHODS`. Defaults to `spatial`.
+
+    Returns
+    -------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, in the columns `id`, `activity_id` (or
+        `trajectory_id` with `trajectory` storage), `lat`, `lon` and
+        `date_time`.
+    """
+    _check_lookup(cnx, method)
+    params = {
+        "min_lat": min_lat,
+        "min_lon": min_lon,
+        "max_lat": max_lat,
+        "max_lon": max_lon,
+        "envelope": _envelope(min_lat, min_lon, max_lat, max_lon),
+    }
+    if method == "scan":
+        del params["envelope"]
+    return pd.read_sql_query(
+        text(_lookup_sql(storage, method)),
+        con=cnx,
+        params=params,
+        parse_dates=["date_time"],
+    )
+
+
+def trackpoints_near(cnx, lat, lon, radius, storage="activity", method="spatial"):
+    """Find the trackpoints within a distance of a point.
+
+    The trackpoints are first filtered on the bounding box of the circle, see
+    `trackpoints_in_bbox`. The exact distance is only computed for the
+    trackpoints in the box, with `ST_Distance_Sphere` in MySQL with the
+    `spatial` method, and with `geo.haversine` with the `scan` method. Both
+    use the same radius of the Earth.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    lat, lon : float
+        The latitude and longitude of the point in degrees.
+    radius : float
+        The distance in meters.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    method : str, optional
+        One of `LOOKUP_METHODS`. Defaults to `spatial`.
+
+    Returns
+    -------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, in the columns of `trackpoints_in_bbox`, and their
+        `distance` to the point in meters.
+    """
+    _check_lookup(cnx, method)
+    min_lat, min_lon, max_lat, max_lon = bounding_box(lat, lon, radius)
+    if method == "spatial":
+        params = {
+            "lat": lat,
+            "lon": lon,
+            "radius": radius,
+            "min_lat": min_lat,
+            "min_lon": min_lon,
+            "max_lat": max_lat,
+            "max_lon": max_lon,
+            "envelope": _envelope(min_lat, min_lon, max_lat, max_lon),
+        }
+        return pd.read_sql_query(
+            text(_lookup_sql(storage, method, radius=True)),
+            con=cnx,
+            params=params,
+            parse_dates=["date_time"],
+        )
+
+    trackpoint_df = trackpoints_in_bbox(
+        cnx, min_lat, min_lon, max_lat, max_lon, storage, method
+    )
+    trackpoint_df["distance"] = haversine(
+        lat, lon, trackpoint_df["lat"], trackpoint_df["lon"]
+    )
+    return trackpoint_df.loc[trackpoint_df["distance"] <= radius].reset_index(
+        drop=True
+    )
+
+
+def activities_of(cnx, trackpoint_df, storage="activity"):
+    """Find the activities of the trackpoints found by a lookup.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, as returned by `trackpoints_in_bbox` or
+        `trackpoints_near`.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. With
+        `trajectory` storage every activity of a trajectory is returned.
+        Defaults to `activity`.
+
+    Returns
+    -------
+    activity_df : Pandas DataFrame
+        The activities, in the columns `activity_id`, `user_id`,
+        `transportation_mode`, `start_date_time`, `end_date_time`, the
+        `point_count` of trackpoints found, and their `min_distance` to the
+        point with `trackpoints_near`, ordered by activity.
+    """
+    key = "activity_id" if storage == "activity" else "trajectory_id"
+    aggregations = {"point_count": ("id", "size")}
+    if "distance" in trackpoint_df:
+        aggregations["min_distance"] = ("distance", "min")
+    found_df = trackpoint_df.groupby(key).agg(**aggregations).reset_index()
+
+    if storage == "activity":
+        query = """
+                SELECT
+                  Activity.id AS activity_id,
+                  Activity.user_id,
+                  Activity.transportation_mode,
+                  Activity.start_date_time,
+                  Activity.end_date_time
+                FROM
+                  Activity
+                WHERE
+                  Activity.id IN :ids
+                """
+    else:
+        query = """
+                SELECT
+                  ActivityTrajectory.trajectory_id,
+                  Activity.id AS activity_id,
+                  Activity.user_id,
+                  Activity.transportation_mode,
+                  Activity.start_date_time,
+                  Activity.end_date_time
+                FROM
+                  ActivityTrajectory
+                  JOIN Activity ON Activity.id = ActivityTrajectory.activity_id
+                WHERE
+                  ActivityTrajectory.trajectory_id IN :ids
+                """
+    activity_df = pd.read_sql_query(
+        text(query).bindparams(bindparam("ids", expanding=True)),
+        con=cnx,
+        params={"ids": [int(value) for value in found_df[key]]},
+    )
+    activity_df = activity_df.merge(found_df, on=key)
+    if storage == "trajectory":
+        activity_df = activity_df.drop(columns="trajectory_id")
+    return activity_df.sort_values("activity_id").reset_index(drop=True)
+
+
+def activities_in_bbox(
+    cnx, min_lat, min_lon, max_lat, max_lon, storage="activity", method="spatial"
+):
+    """Find the activities passing through a latitude and longitude box.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    min_lat, min_lon, max_lat, max_lon : float
+        The box in degrees, including its edges.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    method : str, optional
+        One of `LOOKUP_METHODS`. Defaults to `spatial`.
+
+    Returns
+    -------
+    activity_df : Pandas DataFrame
+        The activities, see `activities_of`.
+    """
+    trackpoint_df = trackpoints_in_bbox(
+        cnx, min_lat, min_lon, max_lat, max_lon, storage, method
+    )
+    return activities_of(cnx, trackpoint_df, storage)
+
+
+def activities_near(cnx, lat, lon, radius, storage="activity", method="spatial"):
+    """Find the activities passing within a distance of a point.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    lat, lon : float
+        The latitude and longitude of the point in degrees.
+    radius : float
+        The distance in meters.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    method : str, optional
+        One of `LOOKUP_METHODS`. Defaults to `spatial`.
+
+    Returns
+    -------
+    activity_df : Pandas DataFrame
+        The activities, see `activities_of`.
+    """
+    trackpoint_df = trackpoints_near(cnx, lat, lon, radius, storage, method)
+    return activities_of(cnx, trackpoint_df, storage)
+
+
+def compare_lookups(
+    cnx, lat, lon, radius, storage="activity", methods=LOOKUP_METHODS, repeat=3
+):
+    """Time the radius and bounding box lookups with the lookup methods.
+
+    The bounding box is the one of the circle. Every lookup is run `repeat`
+    times, and the fastest time is reported, with whether it found the same
+    trackpoints as the `scan` method.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    lat, lon : float
+        The latitude and longitude of the center in degrees.
+    radius : float
+        The radius in meters.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    methods : tuple, optional
+        The lookup methods to time. The `scan` method is always timed.
+        Defaults to `LOOKUP_METHODS`.
+    repeat : int, optional
+        The number of times every lookup is run. Defaults to 3.
+
+    Returns
+    -------
+    compare_df : Pandas DataFrame
+        The `lookup`, `method`, number of `trackpoints`, fastest `seconds`
+        and `same` for every lookup.
+    """
+    methods = ["scan"] + [method for method in methods if method != "scan"]
+    box = bounding_box(lat, lon, radius)
+    lookups = {
+        "radius": lambda method: trackpoints_near(
+            cnx, lat, lon, radius, storage, method
+        ),
+        "bbox": lambda method: trackpoints_in_bbox(cnx, *box, storage, method),
+    }
+    rows = []
+    for lookup, find in lookups.items():
+        found = {}
+        for method in methods:
+            seconds = []
+            for _ in range(repeat):
+                start_time = time.time()
+                trackpoint_df = find(method)
+                seconds.append(time.time() - start_time)
+            found[method] = set(trackpoint_df["id"])
+            rows.append(
+                (
+                    lookup,
+                    method,
+                    len(trackpoint_df),
+                    min(seconds),
+                    found[method] == found["scan"],
+                )
+            )
+    compare_df = pd.DataFrame(
+        rows, columns=["lookup", "method", "trackpoints", "seconds", "same"]
+    )
+    print(
+        tabulate(compare_df.round(4), headers="keys", showindex=False, tablefmt="orgtbl")
+    )
+    return compare_df
+
+
+def read_trajectories(cnx, activity_ids, storage="activity", lod=None):
+    """Read the trajectories of activities, for export or drawing on a map.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    activity_ids : list
+        The ids of the activities.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    lod : int, optional
+        The tolerance in meters of the simplified trajectories to read.
+        Defaults to the full resolution.
+
+    Returns
+    -------
+    trajectory_df : Pandas DataFrame
+        The trackpoints, in the columns `activity_id`, `id`, `lat`, `lon` and
+        `date_time`, ordered by activity and id.
+    """
+    query = f"""
+            SELECT
+              TrackPoint.activity_id,
+              TrackPoint.id,
+              TrackPoint.lat,
+              TrackPoint.lon,
+              TrackPoint.date_time
+            FROM
+              {_trackpoint_source(storage, lod)}
+            WHERE
+              TrackPoint.activity_id IN :ids
+            ORDER BY
+              TrackPoint.activity_id,
+              TrackPoint.id
+            """
+    return pd.read_sql_query(
+        text(query).bindparams(bindparam("ids", expanding=True)),
+        con=cnx,
+        params={"ids": [int(value) for value in activity_ids]},
+        parse_dates=["date_time"],
+    )
+
+
+def lod_report(cnx, storage="activity", chunksize=None):
+    """Print the error of every level of detail against the full resolution.
+
+    Every trajectory is read at full resolution and at every level, see
+    `simplify.lod_errors`. The distance is the total length of all
+    trajectories, as summed by query 10.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+    storage : str, optional
+        How the trackpoints are stored, one of `tables.STORAGES`. Defaults to
+        `activity`.
+    chunksize : int, optional
+        Stream the trackpoints of both tables in chunks of this many rows,
+        see `read_sql_chunks`, and measure a few trajectories at a time.
+        Defaults to reading all trackpoints at once.
+
+    Returns
+    -------
+    report_df : Pandas DataFrame
+        The `tolerance` in meters, `rows`, `reduction` in rows, `distance` in
+        kilometers, relative `distance_error`, and `max_deviation` and
+        `mean_deviation` in meters of every level, after the full resolution
+        with a tolerance of 0.
+    """
+    key = "activity_id" if storage == "activity" else "trajectory_id"
+    tolerances = [0] + sorted(
+        pd.read_sql_query(
+            "SELECT DISTINCT tolerance FROM TrackPointLOD", con=cnx
+        )["tolerance"].tolist()
+    )
+    # The full resolution is the level with a tolerance of 0
+    query = f"""
+            SELECT 0 AS tolerance, {key}, id, lat, lon FROM TrackPoint
+            UNION ALL
+            SELECT tolerance, {key}, id, lat, lon FROM TrackPointLOD
+            """
+    if chunksize is not None:
+        batches = _whole_paths(
+            read_sql_chunks(cnx, query + f" ORDER BY {key}, tolerance, id", chunksize),
+            by=key,
+        )
+    else:
+        batches = [pd.read_sql_query(query, con=cnx)]
+
+    sums = {tolerance: [] for tolerance in tolerances}
+    for batch_df in batches:
+        trackpoint_df = batch_df.loc[batch_df["tolerance"] == 0]
+        for tolerance in tolerances:
+            lod_df = batch_df.loc[batch_df["tolerance"] == tolerance]
+            sums[tolerance].append(lod_error_sums(trackpoint_df, lod_df, by=key))
+    report_df = pd.DataFrame(
+        [
+            {"tolerance": tolerance, **combine_lod_errors(sums[tolerance])}
+            for tolerance in tolerances
+        ]
+    )
+    report_df["distance"] = report_df["distance"] / 1000  # kilometers
+    print(
+        tabulate(report_df.round(4), headers="keys", showindex=False, tablefmt="orgtbl")
+    )
+    return report_df
+
+
+def _whole_paths(chunks, by):
+    """Helper function to regroup chunks of rows ordered by path into whole paths.
+
+    Parameters
+    ----------
+    chunks : iterator
+        The rows as Pandas DataFrames, ordered by `by`.
+    by : str
+        The column identifying the path of a row.
+
+    Yields
+    ------
+    df : Pandas DataFrame
+        The rows of one or more whole paths.
+    """
+    carry = None
+    for chunk in chunks:
+        df = chunk if carry is None else pd.concat([carry, chunk], ignore_index=True)
+        if len(df) == 0:
+            continue
+        # The last path may go on in the next chunk
+        done = df[by].values != df[by].values[-1]
+        if done.any():
+            yield df.loc[done]
+        carry = df.loc[~done]
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+# The query functions by number
+QUERIES = {
+    1: query_1,
+    2: query_2,
+    3: query_3,
+    4: query_4,
+    5: query_5,
+    6: query_6,
+    7: query_7,
+    8: query_8,
+    9: query_9,
+    10: query_10,
+    11: query_11,
+    12: query_12,
+}
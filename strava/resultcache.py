@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""Code to cache the results of the queries between inserts.
+
+This module contains a two tier cache of query results. Results are kept in
+an in-process LRU tier, and optionally on disk in the NumPy column format of
+`cache.save_frame`, with the least recently used entries evicted when the
+disk tier grows beyond its size limit. Entries are keyed by the query number,
+the query options and the version stamp of the `DatasetVersion` table, which
+`insert_data` bumps after every insert, so stale results are never returned.
+The stamp holds a random part drawn on every insert, so the results of a
+database that was dropped and rebuilt are not mistaken for the current ones.
+
+The version stamp itself is cached for `version_ttl` seconds, so that repeated
+queries within that time are answered without a database round-trip. Results
+may thus be stale for up to `version_ttl` seconds after an insert from another
+process. After an insert in the same process, `QueryCache.invalidate` makes
+the next lookup read the version again.
+
+"""
+import os
+import time
+import shutil
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from cache import save_frame
+from cache import load_frame
+
+# Default number of results kept in memory
+MAX_ENTRIES = 64
+
+# Default size of the disk tier in bytes
+MAX_BYTES = 256 * 1024 * 1024
+
+# Default number of seconds the dataset version is trusted without asking
+# the database again
+VERSION_TTL = 5
+
+
+def read_version(cnx):
+    """Read the dataset version stamp.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+
+    Returns
+    -------
+    version : str
+        The version of the dataset and its random stamp, or `0` if nothing
+        was inserted yet.
+    """
+    row = cnx.execute(
+        text("SELECT version, stamp FROM DatasetVersion WHERE id = 1")
+    ).first()
+    return "0" if row is None else f"{int(row[0])}-{row[1]}"
+
+
+def bump_version(cnx):
+    """Bump the dataset version stamp after an insert.
+
+    The version is counted up, and the stamp replaced by a new random one.
+
+    Parameters
+    ----------
+    cnx : :obj:
+        The sqlalchemy connection object.
+
+    """
+    if cnx.dialect.name == "mysql":
+        upsert = "ON DUPLICATE KEY UPDATE version = version + 1"
+    else:
+        upsert = "ON CONFLICT (id) DO UPDATE SET version = DatasetVersion.version + 1"
+    cnx.execute(
+        text(
+            "INSERT INTO DatasetVersion (id, version, stamp, updated_at) "
+            "VALUES (1, 1, :stamp, CURRENT_TIMESTAMP) "
+            f"{upsert}, stamp = :stamp, updated_at = CURRENT_TIMESTAMP"
+        ),
+        {"stamp": uuid.uuid4().hex},
+    )
+
+
+class QueryCache:
+    """Cache of query results keyed by query, options and dataset version.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory of the disk tier. Defaults to no disk tier.
+    max_entries : int, optional
+        The number of results kept in memory. Defaults to `MAX_ENTRIES`.
+    max_bytes : int, optional
+        The size of the disk tier in bytes. Defaults to `MAX_BYTES`.
+    version_ttl : float, optional
+        The number of seconds the dataset version is trusted without asking
+        the database again. Defaults to `VERSION_TTL`.
+
+    Attributes
+    ----------
+    hits : int
+        The number of results found in memory.
+    disk_hits : int
+        The number of results found on disk.
+    misses : int
+        The number of results that were computed.
+    """
+
+    def __init__(
+        self,
+        cache_dir=None,
+        max_entries=MAX_ENTRIES,
+        max_bytes=MAX_BYTES,
+        version_ttl=VERSION_TTL,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._version_time = 0
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def version(self, sql_engine):
+        """Get the dataset version, asking the database at most once per TTL.
+
+        Parameters
+        ----------
+        sql_engine : :obj:
+            The sqlalchemy engine.
+
+        Returns
+        -------
+        version : str
+            The version of the dataset, see `read_version`.
+        """
+        with self._lock:
+            if (
+                self._version is not None
+                and time.time() - self._version_time < self.version_ttl
+            ):
+                return self._version
+        with sql_engine.connect() as cnx:
+            version = read_version(cnx)
+        with self._lock:
+            self._version, self._version_time = version, time.time()
+        return version
+
+    def invalidate(self):
+        """Forget the dataset version, so it is read again on the next call."""
+        with self._lock:
+            self._version = None
+
+    def get_or_run(self, sql_engine, number, options, run):
+        """Get the result of a query from the cache, or run it and cache it.
+
+        Parameters
+        ----------
+        sql_engine : :obj:
+            The sqlalchemy engine.
+        number : int
+            The number of the query.
+        options : dict
+            The options the query is run with.
+        run : callable
+            Runs the query, and returns its result DataFrame.
+
+        Returns
+        -------
+        query_df : Pandas DataFrame
+            The result of the query.
+        """
+        key = self._key(number, options, self.version(sql_engine))
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key].copy()
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            query_df = load_frame(path, mmap=False)
+            os.utime(path)
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, query_df)
+            return query_df.copy()
+
+        query_df = run()
+        with self._lock:
+            self.misses += 1
+            self._remember(key, query_df)
+        if path is not None:
+            self._store(path, query_df)
+        return query_df.copy()
+
+    def stats(self):
+        """Get the hit and miss counters.
+
+        Returns
+        -------
+        stats : dict
+            The `hits`, `disk_hits` and `misses` counters, and the number of
+            results in memory.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def _key(self, number, options, version):
+        """Helper method to compute the key of a result.
+
+        Parameters
+        ----------
+        number : int
+            The number of the query.
+        options : dict
+            The options the query is run with.
+        version : str
+            The version of the dataset.
+
+        Returns
+        -------
+        key : str
+            The hexadecimal SHA-1 digest of the query, options and version.
+        """
+        key = repr((number, sorted(options.items()), version))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, key):
+        """Helper method to get the disk tier path of a result.
+
+        Parameters
+        ----------
+        key : str
+            The key of the result.
+
+        Returns
+        -------
+        path : str
+            The directory of the result, or None without a disk tier.
+        """
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key)
+
+    def _remember(self, key, query_df):
+        """Helper method to keep a result in memory.
+
+        The least recently used results beyond `max_entries` are evicted.
+
+        Parameters
+        ----------
+        key : str
+            The key of the result.
+        query_df : Pandas DataFrame
+            The result of the query.
+
+        """
+        self._entries[key] = query_df
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _store(self, path, query_df):
+        """Helper method to save a result on disk.
+
+        The least recently used results beyond `max_bytes` are evicted.
+
+        Parameters
+        ----------
+        path : str
+            The directory of the result.
+        query_df : Pandas DataFrame
+            The result of the query.
+
+        """
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        save_frame(tmp_path, query_df)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+        # Evict the least recently used results beyond the size limit
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
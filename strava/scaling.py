@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Scaling benchmarks of the whole pipeline on synthetic datasets.
+
+This module contains code that generates synthetic datasets at several
+scales with `synthetic.generate_dataset`, and times the parse, insert and
+per-query stages on each of them. The timings are saved as JSON, and can be
+compared against the JSON of an earlier run to catch regressions.
+
+    python scaling.py --scales 1 10 100 --backend sqlite --output scaling.json
+    python scaling.py --backend sqlite --baseline scaling.json
+
+"""
+import os
+import json
+import time
+import getpass
+import argparse
+import platform
+
+import pandas as pd
+from tabulate import tabulate
+
+import queries
+from tables import DB_NAME
+from tables import get_tables
+from backends import BACKENDS
+from backends import get_engine
+from database import setup_database
+from database import insert_data
+from database import parse_data
+from database import run_query
+from synthetic import generate_dataset
+
+
+def run_scale(
+    work_dir, scale, users, trajectories, points, backend, user, password, numbers
+):
+    """Generate a dataset at one scale, and time the stages of the pipeline.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory to write the dataset and the embedded database in.
+    scale : int
+        The factor the number of users is multiplied by.
+    users : int
+        The number of users at scale 1.
+    trajectories : int
+        The number of trajectories per user.
+    points : int
+        The average number of trackpoints per trajectory.
+    backend : str
+        One of `backends.BACKENDS`.
+    user : str
+        The entered MySQL user.
+    password : str
+        The entered MySQL password.
+    numbers : list
+        The numbers of the queries to time.
+
+    Returns
+    -------
+    result : dict
+        The size of the dataset, and the time taken by every stage in
+        seconds. Queries that fail on the dataset have no time, and their
+        error under `errors`.
+    """
+    dataset_path = os.path.join(work_dir, f"dataset_{scale}x", "")
+    db_path = os.path.join(work_dir, f"scaling_{scale}x")
+    summary = generate_dataset(
+        dataset_path, users=users * scale, trajectories=trajectories, points=points
+    )
+
+    start_time = time.time()
+    _, activity_df, trackpoint_df = parse_data(dataset_path=dataset_path)
+    parse_seconds = time.time() - start_time
+    summary.update(activities=len(activity_df), rows=len(trackpoint_df))
+    del activity_df, trackpoint_df
+
+    sql_engine = get_engine(backend, user, password, DB_NAME, db_path)
+    setup_database(sql_engine, DB_NAME, get_tables())
+    insert_timings = insert_data(sql_engine, dataset_path=dataset_path)
+
+    latencies, errors = {}, {}
+    for number in numbers:
+        try:
+            _, latencies[number] = run_query(sql_engine, number)
+        except Exception as ex:
+            latencies[number] = None
+            errors[number] = repr(ex)
+    sql_engine.dispose()
+
+    return {
+        "scale": scale,
+        "dataset": summary,
+        "parse_seconds": parse_seconds,
+        "insert_seconds": insert_timings,
+        "query_seconds": latencies,
+        "errors": errors,
+    }
+
+
+def compare(results, baseline):
+    """Print the timings of a run next to the timings of an earlier run.
+
+    Parameters
+    ----------
+    results : dict
+        The results of this run, as saved by `main`.
+    baseline : dict
+        The results of the earlier run.
+
+    Returns
+    -------
+    compare_df : Pandas DataFrame
+        The time taken by every stage at every scale in both runs, and their
+        ratio.
+    """
+    rows = []
+    for run, data in (("current", results), ("baseline", baseline)):
+        for result in data["results"]:
+            stages = {"parse": result["parse_seconds"]}
+            stages["insert"] = sum((result["insert_seconds"] or {}).values())
+            for number, seconds in result["query_seconds"].items():
+                stages[f"query {number}"] = seconds
+            rows.extend(
+                (run, result["scale"], stage, seconds)
+                for stage, seconds in stages.items()
+            )
+    compare_df = (
+        pd.DataFrame(rows, columns=["run", "scale", "stage", "seconds"])
+        .pivot_table(index=["scale", "stage"], columns="run", values="seconds")
+        .reset_index()
+    )
+    compare_df["ratio"] = compare_df["current"] / compare_df["baseline"]
+    print(
+        tabulate(compare_df.round(3), headers="keys", showindex=False, tablefmt="orgtbl")
+    )
+    return compare_df
+
+
+def main():
+    """Run the scaling benchmarks, and save the results as JSON."""
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline on synthetic datasets at several scales."
+    )
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="factors the number of users is multiplied by (default: 1 10 100)",
+    )
+    parser.add_argument(
+        "-u",
+        "--users",
+        type=int,
+        default=5,
+        help="number of users at scale 1 (default: 5)",
+    )
+    parser.add_argument(
+        "-t",
+        "--trajectories",
+        type=int,
+        default=20,
+        help="number of trajectories per user (default: 20)",
+    )
+    parser.add_argument(
+        "-p",
+        "--points",
+        type=int,
+        default=500,
+        help="average number of trackpoints per trajectory (default: 500)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="sqlite",
+        help="backend storing the database (default: sqlite)",
+    )
+    parser.add_argument(
+        "-q",
+        "--queries",
+        type=int,
+        nargs="+",
+        choices=sorted(queries.QUERIES),
+        default=sorted(queries.QUERIES),
+        metavar="N",
+        help="numbers of the queries to time (default: all)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        default="../scaling",
+        help="directory of the datasets and databases (default: ../scaling)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="scaling.json",
+        help="file to save the results in (default: scaling.json)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="results of an earlier run to compare against (default: none)",
+    )
+    args = parser.parse_args()
+
+    user, password = None, None
+    if args.backend == "mysql":
+        user = input("Enter MySQL user: ")
+        password = getpass.getpass(prompt="Enter MySQL password: ")
+
+    results = {
+        "config": {
+            "users": args.users,
+            "trajectories": args.trajectories,
+            "points": args.points,
+            "backend": args.backend,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": [],
+    }
+    for scale in args.scales:
+        print(f"Scale {scale}x:")
+        results["results"].append(
+            run_scale(
+                args.work_dir,
+                scale,
+                args.users,
+                args.trajectories,
+                args.points,
+                args.backend,
+                user,
+                password,
+                args.queries,
+            )
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved in {args.output}.")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # JSON keys are strings, so read the results back the same way
+        with open(args.output) as f:
+            results = json.load(f)
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
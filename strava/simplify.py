@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Code to simplify trajectories to levels of detail.
+
+This module contains a vectorized Douglas-Peucker simplification, which
+simplifies all paths of a batch of trackpoints at once. Every round computes
+the distance of the interior points of every open segment to the segment, in
+one pass over all paths, and splits the segments at their farthest point. The
+split points do not depend on the tolerance, so a single run gives the
+tolerance up to which every trackpoint is kept, and every level of detail is
+a filter on it. A level keeps a subset of the trackpoints of every finer
+level.
+
+The simplified paths are stored in the `TrackPointLOD` table at ingest, see
+`database.insert_data`, and `lod_errors` measures them against the full
+resolution. The measures of separate sets of paths can be combined, so the
+paths can be measured a few at a time.
+
+"""
+import numpy as np
+import pandas as pd
+
+from geo import EARTH_RADIUS
+from geo import path_distances
+
+# Default tolerances of the levels of detail in meters
+LOD_TOLERANCES = (5, 20, 100)
+
+
+def simplify_levels(trackpoint_df, tolerances=LOD_TOLERANCES, by="activity_id"):
+    """Simplify the paths of the trackpoints at several tolerances.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `id`, `lat`, `lon`, `date_time` and
+        `by`.
+    tolerances : tuple, optional
+        The largest distance in meters between a removed trackpoint and the
+        simplified path, of every level. Defaults to `LOD_TOLERANCES`.
+    by : str, optional
+        The column identifying the path of a trackpoint. Defaults to
+        `activity_id`.
+
+    Returns
+    -------
+    lod_df : Pandas DataFrame
+        The trackpoints kept at every level, in the columns `tolerance`, `by`,
+        `id`, `lat`, `lon` and `date_time`, ordered by level, path and id.
+    """
+    columns = [by, "id", "lat", "lon", "date_time"]
+    order = np.lexsort((trackpoint_df["id"].values, trackpoint_df[by].values))
+    df = trackpoint_df[columns].iloc[order].reset_index(drop=True)
+    if len(df) == 0 or len(tolerances) == 0:
+        return pd.DataFrame(columns=["tolerance"] + columns)
+
+    kept = keep_distances(
+        df["lat"].values.astype(float),
+        df["lon"].values.astype(float),
+        df[by].values,
+        min(tolerances),
+    )
+    return pd.concat(
+        [
+            df.loc[kept > tolerance].assign(tolerance=tolerance)[
+                ["tolerance"] + columns
+            ]
+            for tolerance in sorted(tolerances)
+        ],
+        ignore_index=True,
+    )
+
+
+def keep_distances(lat, lon, keys, min_tolerance=0):
+    """Compute the tolerance up to which every trackpoint is kept.
+
+    The paths are projected to meters around the mean latitude of every
+    path, and simplified with Douglas-Peucker on the distances to the
+    segments. A point is kept at a tolerance when the farthest distance of
+    its segment, and of every segment it was split from, is larger than the
+    tolerance.
+
+    Parameters
+    ----------
+    lat, lon : ndarray
+        The latitudes and longitudes of the trackpoints in degrees, sorted by
+        path and in the order of every path.
+    keys : ndarray
+        The paths of the trackpoints.
+    min_tolerance : float, optional
+        Segments are not split further once no point is farther than this
+        from them. Defaults to 0, which runs the simplification to the end.
+
+    Returns
+    -------
+    kept : ndarray
+        The tolerance in meters below which every trackpoint is kept. The
+        first and last trackpoints of every path are always kept, with an
+        infinite tolerance.
+    """
+    n = len(keys)
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    ends = np.append(starts[1:], n) - 1
+
+    # Equirectangular projection around the mean latitude of every path
+    codes = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    mean_lat = np.bincount(codes, weights=lat) / np.bincount(codes)
+    x = np.radians(lon) * np.cos(np.radians(mean_lat[codes])) * EARTH_RADIUS
+    y = np.radians(lat) * EARTH_RADIUS
+
+    kept = np.zeros(n)
+    kept[starts] = np.inf
+    kept[ends] = np.inf
+    seg_start, seg_end = starts, ends
+    seg_cap = np.full(len(starts), np.inf)
+    while True:
+        # Only segments with interior points can be split
+        open_ = seg_end - seg_start > 1
+        seg_start, seg_end, seg_cap = seg_start[open_], seg_end[open_], seg_cap[open_]
+        if len(seg_start) == 0:
+            break
+
+        lengths = seg_end - seg_start - 1
+        offsets = np.cumsum(lengths) - lengths
+        seg_of = np.repeat(np.arange(len(seg_start)), lengths)
+        points = seg_start[seg_of] + 1 + np.arange(lengths.sum()) - offsets[seg_of]
+        distances = _segment_distances(
+            x[points],
+            y[points],
+            x[seg_start][seg_of],
+            y[seg_start][seg_of],
+            x[seg_end][seg_of],
+            y[seg_end][seg_of],
+        )
+
+        # The first farthest point of every segment
+        seg_max = np.maximum.reduceat(distances, offsets)
+        farthest = np.flatnonzero(distances == seg_max[seg_of])
+        _, first = np.unique(seg_of[farthest], return_index=True)
+        split = points[farthest[first]]
+
+        # A point is dropped with the segment it lies in
+        cap = np.minimum(seg_max, seg_cap)
+        kept[split] = cap
+        more = seg_max > min_tolerance
+        seg_start, seg_end = (
+            np.concatenate((seg_start[more], split[more])),
+            np.concatenate((split[more], seg_end[more])),
+        )
+        seg_cap = np.concatenate((cap[more], cap[more]))
+    return kept
+
+
+def _segment_distances(px, py, ax, ay, bx, by):
+    """Helper function to compute the distances from points to segments.
+
+    Parameters
+    ----------
+    px, py : ndarray
+        The coordinates of the points in meters.
+    ax, ay, bx, by : ndarray
+        The coordinates of the ends of the segments in meters.
+
+    Returns
+    -------
+    distances : ndarray
+        The distance from every point to the closest point of its segment.
+    """
+    dx, dy = bx - ax, by - ay
+    length = dx ** 2 + dy ** 2
+    # Segments whose ends coincide are points
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length > 0, ((px - ax) * dx + (py - ay) * dy) / length, 0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def lod_errors(trackpoint_df, lod_df, by="activity_id"):
+    """Measure a level of detail against the full resolution.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints at full resolution, with the columns `id`, `lat`,
+        `lon` and `by`.
+    lod_df : Pandas DataFrame
+        The trackpoints kept at the level, with the same columns. They must
+        be a subset of `trackpoint_df` that includes the first and last
+        trackpoints of every path.
+    by : str, optional
+        The column identifying the path of a trackpoint. Defaults to
+        `activity_id`.
+
+    Returns
+    -------
+    errors : dict
+        The number of `rows` at the level, the `reduction` in rows, the
+        total path `distance` in meters and its `distance_error` relative
+        to the full resolution, and the `max_deviation` and `mean_deviation`
+        in meters of the full resolution trackpoints from the simplified
+        paths.
+    """
+    return combine_lod_errors([lod_error_sums(trackpoint_df, lod_df, by=by)])
+
+
+def lod_error_sums(trackpoint_df, lod_df, by="activity_id"):
+    """Measure a level of detail on some of the paths.
+
+    The sums of separate sets of paths add up to the sums of all of them,
+    which `combine_lod_errors` turns into the errors of `lod_errors`.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints at full resolution, see `lod_errors`.
+    lod_df : Pandas DataFrame
+        The trackpoints kept at the level, see `lod_errors`.
+    by : str, optional
+        The column identifying the path of a trackpoint. Defaults to
+        `activity_id`.
+
+    Returns
+    -------
+    sums : dict
+        The number of `points` at full resolution and of `rows` at the
+        level, the `full_distance` and `distance` of the paths in meters,
+        and the `max_deviation` and `deviation_sum` in meters of the full
+        resolution trackpoints from the simplified paths.
+    """
+    order = np.lexsort((trackpoint_df["id"].values, trackpoint_df[by].values))
+    df = trackpoint_df.iloc[order].reset_index(drop=True)
+    keys = df[by].values
+    kept = (
+        pd.MultiIndex.from_arrays([keys, df["id"].values])
+        .isin(pd.MultiIndex.from_arrays([lod_df[by].values, lod_df["id"].values]))
+    )
+
+    # The kept trackpoints before and after every trackpoint of its path
+    positions = np.arange(len(df))
+    before = np.maximum.accumulate(np.where(kept, positions, 0))
+    after = np.minimum.accumulate(np.where(kept, positions, len(df) - 1)[::-1])[::-1]
+
+    # Project around the latitude of every point
+    lat = df["lat"].values.astype(float)
+    lon = df["lon"].values.astype(float)
+    scale = np.cos(np.radians(lat)) * EARTH_RADIUS
+    x = np.radians(lon) * scale
+    y = np.radians(lat) * EARTH_RADIUS
+    deviation = _segment_distances(
+        x,
+        y,
+        np.radians(lon[before]) * scale,
+        y[before],
+        np.radians(lon[after]) * scale,
+        y[after],
+    )
+
+    _, full_distance = path_distances(df, by=by)
+    _, distance = path_distances(df.loc[kept], by=by)
+    return {
+        "points": len(df),
+        "rows": int(kept.sum()),
+        "full_distance": full_distance,
+        "distance": distance,
+        "max_deviation": float(deviation.max()) if len(df) > 0 else 0.0,
+        "deviation_sum": float(deviation.sum()),
+    }
+
+
+def combine_lod_errors(sums):
+    """Combine the sums of `lod_error_sums` into the errors of a level.
+
+    Parameters
+    ----------
+    sums : list
+        The sums of `lod_error_sums` of separate sets of paths.
+
+    Returns
+    -------
+    errors : dict
+        The errors of the level on all paths, see `lod_errors`.
+    """
+    points = sum(s["points"] for s in sums)
+    rows = sum(s["rows"] for s in sums)
+    full_distance = sum(s["full_distance"] for s in sums)
+    distance = sum(s["distance"] for s in sums)
+    return {
+        "rows": rows,
+        "reduction": points / max(rows, 1),
+        "distance": distance,
+        "distance_error": (
+            (full_distance - distance) / full_distance if full_distance > 0 else 0.0
+        ),
+        "max_deviation": max([s["max_deviation"] for s in sums], default=0.0),
+        "mean_deviation": (
+            sum(s["deviation_sum"] for s in sums) / points if points > 0 else 0.0
+        ),
+    }
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Code to summarize the trackpoints of every activity.
+
+This module contains code that computes the `ActivityStats` table from the
+parsed trackpoints while they are inserted, so that queries on per-activity
+aggregates can read the small summary table instead of scanning TrackPoint.
+The trackpoints of an activity are taken in the order of their ids, as in the
+window functions of the queries.
+
+"""
+import numpy as np
+import pandas as pd
+
+from geo import haversine
+
+# Columns of the `ActivityStats` table
+STATS_COLS = [
+    "activity_id",
+    "point_count",
+    "distance",
+    "elevation_gain",
+    "duration",
+    "max_gap",
+    "min_lat",
+    "max_lat",
+    "min_lon",
+    "max_lon",
+]
+
+
+def activity_stats(trackpoint_df, by="activity_id"):
+    """Compute the summary of the trackpoints of every activity.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        Table of trackpoint information, ordered by trackpoint id.
+    by : str, optional
+        The column identifying the activity, or with `trajectory` storage the
+        trajectory, of a trackpoint. Defaults to `activity_id`.
+
+    Returns
+    -------
+    stats_df : Pandas DataFrame
+        The number of trackpoints, the distance in meters, the positive
+        elevation gain in the unit of the altitudes, the duration and the
+        largest time gap between consecutive trackpoints in seconds, and the
+        bounding box of every activity, with the activity in the column
+        `activity_id`.
+    """
+    df = trackpoint_df.sort_values(by, kind="stable")
+    keys = df[by].values
+    if len(keys) == 0:
+        return pd.DataFrame([], columns=STATS_COLS)
+    lat = df["lat"].values.astype(float)
+    lon = df["lon"].values.astype(float)
+    altitude = df["altitude"].astype(float).values
+    seconds = df["date_time"].values.astype("datetime64[s]").astype(np.int64)
+
+    # Steps between consecutive trackpoints, ignoring the step into the first
+    # trackpoint of every activity
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    distance = np.zeros(len(keys))
+    distance[1:] = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    distance[starts] = 0
+    # Missing altitudes give missing steps, which do not count as a gain
+    climb = np.diff(altitude, prepend=np.nan)
+    climb = np.where(climb > 0, climb, 0)
+    climb[starts] = 0
+    gap = np.diff(seconds, prepend=0)
+    gap[starts] = 0
+
+    stats_df = pd.DataFrame(
+        {
+            "activity_id": keys[starts],
+            "point_count": np.diff(np.append(starts, len(keys))),
+            "distance": np.add.reduceat(distance, starts),
+            "elevation_gain": np.add.reduceat(climb, starts),
+            "duration": np.maximum.reduceat(seconds, starts)
+            - np.minimum.reduceat(seconds, starts),
+            "max_gap": np.maximum.reduceat(gap, starts),
+            "min_lat": np.minimum.reduceat(lat, starts),
+            "max_lat": np.maximum.reduceat(lat, starts),
+            "min_lon": np.minimum.reduceat(lon, starts),
+            "max_lon": np.maximum.reduceat(lon, starts),
+        },
+        columns=STATS_COLS,
+    )
+    return stats_df
+
+
+def file_activity_stats(trackpoint_df, manifest_df):
+    """Compute the summary of every activity with `activity` storage.
+
+    A file matching several labels gives one activity per label, and its
+    trackpoints are repeated once per activity, every copy under the id of
+    the last activity of the file. The summary is computed once per file, on
+    the first copy of its trackpoints, and given to every activity of the
+    file.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        Table of trackpoint information, with the column `activity_id`.
+    manifest_df : Pandas DataFrame
+        The manifest records of the files of the trackpoints, with the
+        columns `first_activity_id` and `activity_count`.
+
+    Returns
+    -------
+    stats_df : Pandas DataFrame
+        The summary of every activity, see `activity_stats`.
+    """
+    files = manifest_df.loc[manifest_df["activity_count"] > 0]
+    first = files["first_activity_id"].values.astype(np.int64)
+    count = files["activity_count"].values.astype(np.int64)
+    last = first + count - 1
+
+    # Keep the first copy of the trackpoints of every file
+    df = trackpoint_df.sort_values("id", kind="stable")
+    copies = df["activity_id"].map(pd.Series(count, index=last)).fillna(1).values
+    position = df.groupby("activity_id").cumcount().values
+    size = df.groupby("activity_id")["activity_id"].transform("size").values
+    stats_df = activity_stats(df.loc[position < size // copies], by="activity_id")
+
+    # Every activity of a file gets the summary of the file
+    offsets = np.cumsum(count) - count
+    file_df = pd.DataFrame(
+        {
+            "activity_id": np.repeat(first - offsets, count) + np.arange(count.sum()),
+            "file": np.repeat(last, count),
+        }
+    )
+    stats_df = file_df.merge(
+        stats_df.rename(columns={"activity_id": "file"}), on="file"
+    ).drop(columns="file")
+    return stats_df[STATS_COLS]
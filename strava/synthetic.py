@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Code to generate synthetic Geolife datasets.
+
+This module contains code that writes a dataset folder in the format read by
+`database.parse_data`: a `Data/<uid>/Trajectory/*.plt` file per trajectory,
+with the 6 header lines of the Geolife files, a `labels.txt` file for the
+labeled users, and `labeled_ids.txt`. Some trajectories are longer than
+`database.MAX_TRACKPOINTS`, and some labels are duplicated with another
+transportation mode, so that every branch of the parser is exercised.
+
+    python synthetic.py ../synthetic --users 20 --trajectories 50 --points 500
+
+"""
+import os
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from database import MAX_TRACKPOINTS
+
+# Header lines at the top of every `.plt` file
+PLT_HEADER = [
+    "Geolife trajectory",
+    "WGS 84",
+    "Altitude is in Feet",
+    "Reserved 3",
+    "0,2,255,My Track,0,0,2,8421376",
+    "0",
+]
+
+# Transportation modes of the labels
+MODES = ("walk", "bike", "bus", "car", "taxi", "subway", "train")
+
+# Day zero of the `date_days` column of the `.plt` files
+DAY_ZERO = pd.Timestamp("1899-12-30")
+
+
+def generate_dataset(
+    dataset_path,
+    users=10,
+    trajectories=20,
+    points=500,
+    labeled=0.5,
+    oversized=0.05,
+    duplicates=0.1,
+    seed=0,
+):
+    """Write a synthetic Geolife dataset.
+
+    Every trajectory is a random walk around Beijing with a trackpoint every
+    5 seconds, starting at a random time in 2008 or 2009. The labels of a
+    labeled user match the start and end times of about half of the user's
+    trajectories.
+
+    Parameters
+    ----------
+    dataset_path : str
+        Path to the `dataset` folder to write. An existing `Data` folder is
+        replaced.
+    users : int, optional
+        The number of users. Defaults to 10.
+    trajectories : int, optional
+        The number of trajectories per user. Defaults to 20.
+    points : int, optional
+        The average number of trackpoints per trajectory. Defaults to 500.
+    labeled : float, optional
+        The fraction of users with labels. Defaults to 0.5.
+    oversized : float, optional
+        The fraction of trajectories with more than `MAX_TRACKPOINTS`
+        trackpoints. Defaults to 0.05.
+    duplicates : float, optional
+        The fraction of labels repeated with another transportation mode.
+        Defaults to 0.1.
+    seed : int, optional
+        The seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    summary : dict
+        The number of `users`, `files`, `trackpoints` and `labels` written.
+    """
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(dataset_path, "Data")
+    shutil.rmtree(data_path, ignore_errors=True)
+    os.makedirs(data_path)
+
+    user_ids = [f"{uid:03d}" for uid in range(users)]
+    labeled_users = [uid for uid in user_ids if rng.random() < labeled]
+    with open(os.path.join(dataset_path, "labeled_ids.txt"), "w") as f:
+        f.write("".join(f"{uid}\n" for uid in labeled_users))
+
+    summary = {"users": users, "files": 0, "trackpoints": 0, "labels": 0}
+    for uid in user_ids:
+        trajectory_path = os.path.join(data_path, uid, "Trajectory")
+        os.makedirs(trajectory_path)
+        labels = []
+        for _ in range(trajectories):
+            if rng.random() < oversized:
+                count = MAX_TRACKPOINTS + 1 + int(rng.integers(0, points))
+            else:
+                count = max(2, int(rng.integers(points // 2, 3 * points // 2 + 1)))
+            trackpoint_df = _random_walk(rng, count)
+            start, end = trackpoint_df["date_time"].iloc[[0, -1]]
+            _write_plt(
+                os.path.join(trajectory_path, start.strftime("%Y%m%d%H%M%S.plt")),
+                trackpoint_df,
+            )
+            summary["files"] += 1
+            summary["trackpoints"] += count
+
+            if uid in labeled_users and rng.random() < 0.5:
+                labels.append((start, end, rng.choice(MODES)))
+                if rng.random() < duplicates:
+                    labels.append((start, end, rng.choice(MODES)))
+
+        if uid in labeled_users:
+            labels_df = pd.DataFrame(
+                labels, columns=["Start Time", "End Time", "Transportation Mode"]
+            )
+            for col in ("Start Time", "End Time"):
+                labels_df[col] = labels_df[col].dt.strftime("%Y/%m/%d %H:%M:%S")
+            labels_df.to_csv(
+                os.path.join(data_path, uid, "labels.txt"), sep="\t", index=False
+            )
+            summary["labels"] += len(labels_df)
+    return summary
+
+
+def _random_walk(rng, count):
+    """Helper function to generate the trackpoints of a trajectory.
+
+    Parameters
+    ----------
+    rng : :obj:
+        The NumPy random number generator.
+    count : int
+        The number of trackpoints.
+
+    Returns
+    -------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `lat`, `lon`, `altitude` and
+        `date_time`.
+    """
+    start_time = pd.Timestamp("2008-01-01") + pd.Timedelta(
+        seconds=int(rng.integers(0, 2 * 365 * 24 * 60 * 60))
+    )
+    walk = np.cumsum(rng.normal(0, 0.0001, (count, 2)), axis=0)
+    altitude = np.round(100 + np.cumsum(rng.normal(0, 3, count)))
+    # Unknown altitudes are recorded as -777
+    altitude[rng.random(count) < 0.01] = -777
+    return pd.DataFrame(
+        {
+            "lat": 39.9 + rng.random() * 0.1 + walk[:, 0],
+            "lon": 116.3 + rng.random() * 0.1 + walk[:, 1],
+            "altitude": altitude.astype(int),
+            "date_time": start_time + pd.to_timedelta(5 * np.arange(count), unit="s"),
+        }
+    )
+
+
+def _write_plt(path, trackpoint_df):
+    """Helper function to write a trajectory as a `.plt` file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the `.plt` file.
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, as returned by `_random_walk`.
+
+    """
+    date_time = trackpoint_df["date_time"]
+    plt_df = pd.DataFrame(
+        {
+            "lat": trackpoint_df["lat"].round(6),
+            "lon": trackpoint_df["lon"].round(6),
+            "ignore": 0,
+            "altitude": trackpoint_df["altitude"],
+            "date_days": ((date_time - DAY_ZERO) / pd.Timedelta(days=1)).round(10),
+            "date": date_time.dt.strftime("%Y-%m-%d"),
+            "time": date_time.dt.strftime("%H:%M:%S"),
+        }
+    )
+    # The keyword of the line terminator of `to_csv` changed name in pandas
+    # 1.5, so the lines are joined here
+    lines = PLT_HEADER + plt_df.to_csv(header=False, index=False).splitlines()
+    with open(path, "w", newline="") as f:
+        f.write("".join(f"{line}\r\n" for line in lines))
+
+
+def main():
+    """Generate a synthetic dataset."""
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset.")
+    parser.add_argument("dataset_path", help="path to the dataset folder to write")
+    parser.add_argument(
+        "-u", "--users", type=int, default=10, help="number of users (default: 10)"
+    )
+    parser.add_argument(
+        "-t",
+        "--trajectories",
+        type=int,
+        default=20,
+        help="number of trajectories per user (default: 20)",
+    )
+    parser.add_argument(
+        "-p",
+        "--points",
+        type=int,
+        default=500,
+        help="average number of trackpoints per trajectory (default: 500)",
+    )
+    parser.add_argument(
+        "-s", "--seed", type=int, default=0, help="random seed (default: 0)"
+    )
+    args = parser.parse_args()
+
+    summary = generate_dataset(
+        args.dataset_path,
+        users=args.users,
+        trajectories=args.trajectories,
+        points=args.points,
+        seed=args.seed,
+    )
+    print(
+        f"Generated {summary['users']} users, {summary['files']} files, "
+        f"{summary['trackpoints']} trackpoints and {summary['labels']} labels."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,30 @@
 This module contains code which defines the tables, their fields and their
 constraints used to setup the `TDT4225ProjectGroup78` database. The database
 name is stored in the string `DB_NAME` variable. The tables are stored in a dict
-named `TABLES`.
+named `TABLES`. `get_tables` returns the tables for the different ways of
+storing the trackpoints, schemas and partitionings, optionally with a spatial
+index on the trackpoints and the simplified trajectories, and `get_indexes`
+the indexes created after the data is inserted.
 
 """
+import re
+
+# Ways of storing the trackpoints of activities that share a trajectory.
+# `activity` repeats the trackpoints for every activity, while `trajectory`
+# stores them once and maps the activities to them in `ActivityTrajectory`.
+STORAGES = ("activity", "trajectory")
+
+# Schemas of the tables. `default` uses the original column types, while
+# `compact` narrows the TrackPoint columns and defers its indexes.
+SCHEMAS = ("default", "compact")
+
+# Range partitionings of the TrackPoint table on `date_time`. `none` keeps a
+# single partition, while `year` and `month` create one partition per year or
+# month in `PARTITION_YEARS`, plus one partition on either side.
+PARTITIONS = ("none", "year", "month")
+
+# Years covered by the Geolife dataset
+PARTITION_YEARS = range(2007, 2013)
 
 # Name of database
 DB_NAME = "TDT4225ProjectGroup78"
@@ -49,3 +70,359 @@ TABLES["TrackPoint"] = (
     "          ON UPDATE CASCADE ON DELETE CASCADE"
     ") ENGINE=InnoDB"
 )
+
+# Summary of the trackpoints of every activity, computed while inserting. The
+# distance is in meters, the elevation gain in the unit of the altitude
+# (feet), and the duration and the largest gap between consecutive
+# trackpoints in seconds.
+TABLES["ActivityStats"] = (
+    "CREATE TABLE `ActivityStats` ("
+    "  `activity_id` INT NOT NULL,"
+    "  `point_count` INT NOT NULL,"
+    "  `distance` DOUBLE NOT NULL,"
+    "  `elevation_gain` DOUBLE NOT NULL,"
+    "  `duration` INT NOT NULL,"
+    "  `max_gap` INT NOT NULL,"
+    "  `min_lat` DOUBLE NOT NULL,"
+    "  `max_lat` DOUBLE NOT NULL,"
+    "  `min_lon` DOUBLE NOT NULL,"
+    "  `max_lon` DOUBLE NOT NULL,"
+    "  CONSTRAINT `ActivityStats_PK` PRIMARY KEY (`activity_id`),"
+    "  CONSTRAINT `ActivityStats_FK` FOREIGN KEY (`activity_id`) REFERENCES `Activity` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+# Size, modification time and hash of every inserted `.plt` and `labels.txt`
+# file, and the ids of the activities created from it. Used to find the files
+# that changed since the last insert. Files skipped for their size are not
+# hashed.
+TABLES["Manifest"] = (
+    "CREATE TABLE `Manifest` ("
+    "  `path` VARCHAR(255) NOT NULL,"
+    "  `user_id` VARCHAR(3) NOT NULL,"
+    "  `size` BIGINT NOT NULL,"
+    "  `mtime` DOUBLE NOT NULL,"
+    "  `sha1` CHAR(40),"
+    "  `first_activity_id` INT,"
+    "  `activity_count` INT NOT NULL,"
+    "  CONSTRAINT `Manifest_PK` PRIMARY KEY (`path`),"
+    "  CONSTRAINT `Manifest_FK` FOREIGN KEY (`user_id`) REFERENCES `User` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+# Version stamp of the data, bumped after every insert. Cached query results
+# are only valid for the version they were computed from. The version starts
+# over when the database is rebuilt, so every insert also draws a random
+# `stamp`, unique across rebuilds.
+TABLES["DatasetVersion"] = (
+    "CREATE TABLE `DatasetVersion` ("
+    "  `id` TINYINT NOT NULL,"
+    "  `version` INT NOT NULL,"
+    "  `stamp` CHAR(32) NOT NULL,"
+    "  `updated_at` DATETIME NOT NULL,"
+    "  CONSTRAINT `DatasetVersion_PK` PRIMARY KEY (`id`)"
+    ") ENGINE=InnoDB"
+)
+
+# Tables replacing the `TrackPoint` table with `trajectory` storage. The
+# trackpoints of a trajectory are stored once, under the id of the first
+# activity created from the trajectory.
+TRAJECTORY_TABLES = {}
+
+TRAJECTORY_TABLES["ActivityTrajectory"] = (
+    "CREATE TABLE `ActivityTrajectory` ("
+    "  `activity_id` INT NOT NULL,"
+    "  `trajectory_id` INT NOT NULL,"
+    "  CONSTRAINT `ActivityTrajectory_PK` PRIMARY KEY (`activity_id`),"
+    "  CONSTRAINT `ActivityTrajectory_FK` FOREIGN KEY (`activity_id`) REFERENCES `Activity` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE,"
+    "  CONSTRAINT `ActivityTrajectory_Trajectory_FK` FOREIGN KEY (`trajectory_id`) REFERENCES `Activity` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+TRAJECTORY_TABLES["TrackPoint"] = (
+    "CREATE TABLE `TrackPoint` ("
+    "  `id` INT NOT NULL,"
+    "  `trajectory_id` INT NOT NULL,"
+    "  `lat` DOUBLE NOT NULL,"
+    "  `lon` DOUBLE NOT NULL,"
+    "  `altitude` INT,"
+    "  `date_days` DOUBLE NOT NULL,"
+    "  `date_time` DATETIME NOT NULL,"
+    "  CONSTRAINT `TrackPoint_PK` PRIMARY KEY (`id`),"
+    "  CONSTRAINT `TrackPoint_FK` FOREIGN KEY (`trajectory_id`) REFERENCES `Activity` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+
+# Trackpoints kept by the simplification of every trajectory at every
+# tolerance in meters, see `simplify`. The primary key clusters the rows of a
+# level by activity, so a query reads one level in order.
+LOD_TABLE = (
+    "CREATE TABLE `TrackPointLOD` ("
+    "  `tolerance` SMALLINT NOT NULL,"
+    "  `{key}` INT NOT NULL,"
+    "  `id` INT NOT NULL,"
+    "  `lat` DOUBLE NOT NULL,"
+    "  `lon` DOUBLE NOT NULL,"
+    "  `date_time` DATETIME NOT NULL,"
+    "  CONSTRAINT `TrackPointLOD_PK` PRIMARY KEY (`tolerance`, `{key}`, `id`),"
+    "  CONSTRAINT `TrackPointLOD_FK` FOREIGN KEY (`{key}`) REFERENCES `Activity` (`id`)"
+    "          ON UPDATE CASCADE ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+
+# `TrackPoint` table of the `compact` schema. The coordinates are stored as
+# fixed point decimals with the 6 decimals of the `.plt` files, and `date_days`
+# is dropped as it holds the same information as `date_time`. The foreign key
+# is added after the insert together with the indexes, see `get_indexes`.
+COMPACT_TRACKPOINT = (
+    "CREATE TABLE `TrackPoint` ("
+    "  `id` INT NOT NULL,"
+    "  `{key}` INT NOT NULL,"
+    "  `lat` DECIMAL(8, 6) NOT NULL,"
+    "  `lon` DECIMAL(9, 6) NOT NULL,"
+    "  `altitude` MEDIUMINT,"
+    "  `date_time` DATETIME NOT NULL,"
+    "  CONSTRAINT `TrackPoint_PK` PRIMARY KEY (`id`)"
+    ") ENGINE=InnoDB"
+)
+
+# Statements creating the foreign key and secondary indexes of the `compact`
+# schema. They are executed after the insert, as building an index once is
+# much faster than maintaining it during the insert. The TrackPoint index
+# serves the queries partitioning the trackpoints by activity, and the
+# Activity indexes serve the queries filtering on user, mode and time.
+COMPACT_INDEXES = {}
+COMPACT_INDEXES["TrackPoint_{key}_id"] = (
+    "CREATE INDEX `TrackPoint_{key}_id` ON `TrackPoint` (`{key}`, `id`)"
+)
+COMPACT_INDEXES["TrackPoint_FK"] = (
+    "ALTER TABLE `TrackPoint` ADD CONSTRAINT `TrackPoint_FK`"
+    "  FOREIGN KEY (`{key}`) REFERENCES `Activity` (`id`)"
+    "  ON UPDATE CASCADE ON DELETE CASCADE"
+)
+COMPACT_INDEXES["Activity_user_id_transportation_mode"] = (
+    "CREATE INDEX `Activity_user_id_transportation_mode`"
+    "  ON `Activity` (`user_id`, `transportation_mode`)"
+)
+COMPACT_INDEXES["Activity_user_id_start_date_time_end_date_time"] = (
+    "CREATE INDEX `Activity_user_id_start_date_time_end_date_time`"
+    "  ON `Activity` (`user_id`, `start_date_time`, `end_date_time`)"
+)
+
+# Location of the trackpoints as a geographic point, for the radius and
+# bounding box lookups of `queries`. It is a stored generated column, so it
+# is filled from `lat` and `lon` by every insert, whatever the load method.
+# SRID 4326 has latitude-longitude axis order in MySQL 8. A spatial index
+# needs a `NOT NULL` column with a fixed SRID, and InnoDB does not support
+# spatial indexes on partitioned tables.
+SPATIAL_COLUMN = (
+    "  `location` POINT AS (ST_SRID(POINT(`lat`, `lon`), 4326)) STORED"
+    " NOT NULL SRID 4326,"
+)
+SPATIAL_INDEX = "SPATIAL INDEX `TrackPoint_location` (`location`)"
+SPATIAL_INDEXES = {}
+SPATIAL_INDEXES["TrackPoint_location"] = (
+    "CREATE SPATIAL INDEX `TrackPoint_location` ON `TrackPoint` (`location`)"
+)
+
+
+def _trackpoint_key(storage):
+    """Helper function to get the column linking trackpoints to activities.
+
+    Parameters
+    ----------
+    storage : str
+        One of `STORAGES`.
+
+    Returns
+    -------
+    key : str
+        The name of the column.
+    """
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown storage: {storage}")
+    return "activity_id" if storage == "activity" else "trajectory_id"
+
+
+def _partition_trackpoint(table_description, partition):
+    """Helper function to range partition the `TrackPoint` table on `date_time`.
+
+    MySQL requires every unique key of a partitioned table to include the
+    partitioning column, and does not support foreign keys on partitioned
+    tables. The primary key is therefore extended with `date_time`, and the
+    foreign key is dropped.
+
+    Parameters
+    ----------
+    table_description : str
+        The MySQL statement creating the `TrackPoint` table.
+    partition : str
+        One of `PARTITIONS`, other than `none`.
+
+    Returns
+    -------
+    table_description : str
+        The MySQL statement creating the partitioned `TrackPoint` table.
+    """
+    bounds = []
+    for year in PARTITION_YEARS:
+        months = range(1, 13) if partition == "month" else [1]
+        bounds.extend(f"{year}-{month:02d}-01" for month in months)
+    bounds.append(f"{PARTITION_YEARS[-1] + 1}-01-01")
+
+    partitions = [f"PARTITION p_start VALUES LESS THAN ('{bounds[0]}')"]
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        name = lower[:7].replace("-", "") if partition == "month" else lower[:4]
+        partitions.append(f"PARTITION p{name} VALUES LESS THAN ('{upper}')")
+    partitions.append("PARTITION p_end VALUES LESS THAN (MAXVALUE)")
+
+    table_description = table_description.replace(
+        "PRIMARY KEY (`id`)", "PRIMARY KEY (`id`, `date_time`)"
+    )
+    table_description = re.sub(
+        r",\s*CONSTRAINT `TrackPoint_FK`.*?ON DELETE CASCADE", "", table_description
+    )
+    return (
+        f"{table_description}"
+        " PARTITION BY RANGE COLUMNS(`date_time`) ("
+        f"{', '.join(partitions)}"
+        ")"
+    )
+
+
+def _spatial_trackpoint(table_description, schema):
+    """Helper function to add the `location` column to the `TrackPoint` table.
+
+    With the `default` schema the spatial index is created with the table,
+    and with the `compact` schema after the insert, see `get_indexes`.
+
+    Parameters
+    ----------
+    table_description : str
+        The MySQL statement creating the `TrackPoint` table.
+    schema : str
+        One of `SCHEMAS`.
+
+    Returns
+    -------
+    table_description : str
+        The MySQL statement creating the `TrackPoint` table with the
+        `location` column.
+    """
+    columns = SPATIAL_COLUMN
+    if schema == "default":
+        columns += f"  {SPATIAL_INDEX},"
+    return table_description.replace(
+        "  CONSTRAINT `TrackPoint_PK`", f"{columns}  CONSTRAINT `TrackPoint_PK`"
+    )
+
+
+def _check_spatial(spatial, partition):
+    """Helper function to check that a spatial index can be created.
+
+    Parameters
+    ----------
+    spatial : bool
+        Add the spatial index.
+    partition : str
+        One of `PARTITIONS`.
+
+    """
+    if spatial and partition != "none":
+        raise ValueError("Spatial indexes are not supported on partitioned tables")
+
+
+def get_tables(
+    storage="activity", schema="default", partition="none", spatial=False, lod=False
+):
+    """Get the tables for a way of storing the trackpoints.
+
+    Parameters
+    ----------
+    storage : str, optional
+        One of `STORAGES`. Defaults to `activity`.
+    schema : str, optional
+        One of `SCHEMAS`. Defaults to `default`.
+    partition : str, optional
+        One of `PARTITIONS`. Defaults to `none`.
+    spatial : bool, optional
+        Add the `location` column and its spatial index to the `TrackPoint`
+        table. Can not be combined with partitioning. Defaults to False.
+    lod : bool, optional
+        Add the `TrackPointLOD` table of the simplified trajectories.
+        Defaults to False.
+
+    Returns
+    -------
+    tables : dict
+        The tables and their MySQL statements, in the order they must be
+        created.
+    """
+    key = _trackpoint_key(storage)
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown schema: {schema}")
+    if partition not in PARTITIONS:
+        raise ValueError(f"Unknown partition: {partition}")
+    _check_spatial(spatial, partition)
+
+    tables = {}
+    for table_name, table_description in TABLES.items():
+        if table_name == "TrackPoint" and storage == "trajectory":
+            tables.update(TRAJECTORY_TABLES)
+        else:
+            tables[table_name] = table_description
+    if schema == "compact":
+        tables["TrackPoint"] = COMPACT_TRACKPOINT.format(key=key)
+    if spatial:
+        tables["TrackPoint"] = _spatial_trackpoint(tables["TrackPoint"], schema)
+    if partition != "none":
+        tables["TrackPoint"] = _partition_trackpoint(tables["TrackPoint"], partition)
+    if lod:
+        tables["TrackPointLOD"] = LOD_TABLE.format(key=key)
+    return tables
+
+
+def get_indexes(storage="activity", schema="default", partition="none", spatial=False):
+    """Get the statements creating indexes after the data is inserted.
+
+    Parameters
+    ----------
+    storage : str, optional
+        One of `STORAGES`. Defaults to `activity`.
+    schema : str, optional
+        One of `SCHEMAS`. Defaults to `default`.
+    partition : str, optional
+        One of `PARTITIONS`. Partitioned tables get no foreign key. Defaults to
+        `none`.
+    spatial : bool, optional
+        Create the spatial index of the `TrackPoint` table. Defaults to False.
+
+    Returns
+    -------
+    indexes : dict
+        The indexes and their MySQL statements, in the order they must be
+        created.
+    """
+    key = _trackpoint_key(storage)
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown schema: {schema}")
+    if partition not in PARTITIONS:
+        raise ValueError(f"Unknown partition: {partition}")
+    _check_spatial(spatial, partition)
+    if schema == "default":
+        return {}
+    indexes = {
+        index_name.format(key=key): index_description.format(key=key)
+        for index_name, index_description in COMPACT_INDEXES.items()
+        if not (index_name == "TrackPoint_FK" and partition != "none")
+    }
+    if spatial:
+        indexes.update(SPATIAL_INDEXES)
+    return indexes
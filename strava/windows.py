@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""Code to answer the window function queries from columnar arrays.
+
+Queries 11 and 12 compare every trackpoint with the previous trackpoint of its
+activity, which MySQL computes with `LAG() OVER (PARTITION BY activity_id ...)`
+over the whole TrackPoint table. This module computes the same answers from
+the trackpoint columns sorted by activity and trackpoint id, with one
+`np.diff` over all trackpoints and a mask on the first trackpoint of every
+activity, and groups the results by activity and user with `np.bincount`.
+
+The columns can come from the parsed DataFrames, the parse cache, or a plain
+scan of the tables, see `queries.read_window_columns`, which can also stream
+them in chunks ordered by activity and trackpoint id.
+
+"""
+import numpy as np
+import pandas as pd
+
+# Engines that can be used to answer queries 11 and 12
+WINDOW_ENGINES = ("sql", "numpy")
+
+
+def elevation_gain_by_user(activity_df, trackpoint_df, by="activity_id", limit=20):
+    """Compute the total elevation gain of the users, as in query 11.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `user_id` and `by`.
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `id`, `altitude` and `by`.
+    by : str, optional
+        The column identifying the activity, or with `trajectory` storage the
+        trajectory, of a trackpoint. Defaults to `activity_id`.
+    limit : int, optional
+        The number of users returned. Defaults to 20.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The users with the largest sum of positive altitude differences
+        between consecutive trackpoints, in the columns `user_id` and
+        `total_elevation_gain`.
+    """
+    return elevation_gain_by_user_stream(activity_df, [trackpoint_df], by, limit)
+
+
+def elevation_gain_by_user_stream(activity_df, chunks, by="activity_id", limit=20):
+    """Compute the total elevation gain of the users from chunks of trackpoints.
+
+    The chunks must be ordered by `by` and `id`, see `_key_sums`.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `user_id` and `by`.
+    chunks : iterable
+        The trackpoints as Pandas DataFrames, with the columns `id`,
+        `altitude` and `by`.
+    by : str, optional
+        The column identifying the activity, or with `trajectory` storage the
+        trajectory, of a trackpoint. Defaults to `activity_id`.
+    limit : int, optional
+        The number of users returned. Defaults to 20.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The result of `elevation_gain_by_user`.
+    """
+
+    def climbs(altitude, first):
+        # Missing altitudes give missing steps, which are left out as in SQL
+        climb = np.diff(altitude.astype(float), prepend=np.nan)
+        climb[first] = np.nan
+        return (np.where(climb > 0, climb, 0), climb > 0)
+
+    keys, gain, climbed = _key_sums(chunks, "altitude", by, climbs)
+    users, user_gain, user_climbs = _sum_by_user(activity_df, keys, by, gain, climbed)
+    query_df = pd.DataFrame({"user_id": users, "total_elevation_gain": user_gain})
+    query_df = query_df.loc[user_climbs > 0]
+    return _sort_desc(query_df, "total_elevation_gain").head(limit)
+
+
+def invalid_activities_by_user(
+    activity_df, trackpoint_df, by="activity_id", max_seconds=300
+):
+    """Count the activities with a gap of more than 5 minutes, as in query 12.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `user_id` and `by`.
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `id`, `date_time` and `by`.
+    by : str, optional
+        The column identifying the activity, or with `trajectory` storage the
+        trajectory, of a trackpoint. Defaults to `activity_id`.
+    max_seconds : int, optional
+        The largest valid time between consecutive trackpoints in seconds.
+        Defaults to 300.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The users with invalid activities, in the columns `user_id` and
+        `number_of_invalid_activities`.
+    """
+    return invalid_activities_by_user_stream(
+        activity_df, [trackpoint_df], by, max_seconds
+    )
+
+
+def invalid_activities_by_user_stream(
+    activity_df, chunks, by="activity_id", max_seconds=300
+):
+    """Count the activities with a gap of more than 5 minutes from chunks.
+
+    The chunks must be ordered by `by` and `id`, see `_key_sums`.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `user_id` and `by`.
+    chunks : iterable
+        The trackpoints as Pandas DataFrames, with the columns `id`,
+        `date_time` and `by`.
+    by : str, optional
+        The column identifying the activity, or with `trajectory` storage the
+        trajectory, of a trackpoint. Defaults to `activity_id`.
+    max_seconds : int, optional
+        The largest valid time between consecutive trackpoints in seconds.
+        Defaults to 300.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The result of `invalid_activities_by_user`.
+    """
+
+    def gaps(date_time, first):
+        seconds = (
+            pd.to_datetime(date_time).values.astype("datetime64[s]").astype(np.int64)
+        )
+        gap = np.diff(seconds, prepend=0) > max_seconds
+        gap[first] = False
+        return (gap, gap)
+
+    keys, gap, _ = _key_sums(chunks, "date_time", by, gaps)
+    users, _, invalid = _sum_by_user(
+        activity_df, keys, by, gap, gap, activities=True
+    )
+    query_df = pd.DataFrame(
+        {"user_id": users, "number_of_invalid_activities": invalid}
+    )
+    query_df = query_df.loc[invalid > 0]
+    return _sort_desc(query_df, "number_of_invalid_activities")
+
+
+def _key_sums(chunks, column, by, step):
+    """Helper function to sum a step between consecutive trackpoints by activity.
+
+    The last trackpoint of every chunk is carried over to the next chunk, as
+    the previous trackpoint of its first trackpoint. Chunks that follow each
+    other must thus be ordered by `by` and `id`, as a single chunk is sorted
+    here.
+
+    Parameters
+    ----------
+    chunks : iterable
+        The trackpoints as Pandas DataFrames, with the columns `id`, `column`
+        and `by`.
+    column : str
+        The column the step is computed on.
+    by : str
+        The column identifying the activity of a trackpoint.
+    step : callable
+        Takes the sorted values of `column` and the mask of the first
+        trackpoint of every activity, and returns the values to sum and the
+        trackpoints to count.
+
+    Returns
+    -------
+    keys : ndarray
+        The activities.
+    sums : ndarray
+        The sum of the step values of every activity.
+    counts : ndarray
+        The number of counted trackpoints of every activity.
+    """
+    parts = []
+    carry = None
+    for chunk in chunks:
+        df = chunk if carry is None else pd.concat([carry, chunk], ignore_index=True)
+        if len(df) == 0:
+            continue
+        keys, values, first = _sorted_columns(df, column, by)
+        sums, counts = step(values, first)
+        # The carried trackpoint was summed with the previous chunk
+        skip = 0 if carry is None else 1
+        parts.append(
+            pd.DataFrame(
+                {"sum": sums[skip:], "count": counts[skip:].astype(np.int64)},
+                index=keys[skip:],
+            )
+        )
+        carry = df[["id", by, column]].iloc[-1:]
+    if len(parts) == 0:
+        return (np.array([]), np.array([]), np.array([]))
+    key_df = pd.concat(parts).groupby(level=0).sum()
+    return (key_df.index.values, key_df["sum"].values, key_df["count"].values)
+
+
+def _sorted_columns(trackpoint_df, column, by):
+    """Helper function to sort a trackpoint column by activity and id.
+
+    Parameters
+    ----------
+    trackpoint_df : Pandas DataFrame
+        The trackpoints, with the columns `id`, `column` and `by`.
+    column : str
+        The column to sort.
+    by : str
+        The column identifying the activity of a trackpoint.
+
+    Returns
+    -------
+    keys : ndarray
+        The sorted activities of the trackpoints.
+    values : ndarray
+        The sorted values of `column`.
+    first : ndarray
+        True for the first trackpoint of every activity.
+    """
+    order = np.lexsort((trackpoint_df["id"].values, trackpoint_df[by].values))
+    keys = trackpoint_df[by].values[order]
+    values = trackpoint_df[column].values[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return (keys, values, first)
+
+
+def _sum_by_user(activity_df, keys, by, values, counts, activities=False):
+    """Helper function to sum trackpoint values by activity and then by user.
+
+    Parameters
+    ----------
+    activity_df : Pandas DataFrame
+        The activities, with the columns `user_id` and `by`.
+    keys : ndarray
+        The activities of the trackpoints.
+    by : str
+        The column of `activity_df` holding the activities of `keys`.
+    values : ndarray
+        The values of the trackpoints to sum.
+    counts : ndarray
+        True for the trackpoints to count.
+    activities : bool, optional
+        Count the activities with at least one counted trackpoint, rather
+        than the trackpoints. Defaults to False.
+
+    Returns
+    -------
+    users : ndarray
+        The users.
+    sums : ndarray
+        The sum of `values` of every user.
+    user_counts : ndarray
+        The count of every user.
+    """
+    key_index, key_codes = np.unique(keys, return_inverse=True)
+    key_sums = np.bincount(key_codes, weights=values, minlength=len(key_index))
+    key_counts = np.bincount(key_codes, weights=counts, minlength=len(key_index))
+    if activities:
+        key_counts = (key_counts > 0).astype(float)
+
+    # Activities without trackpoints add nothing
+    ranks = pd.Index(key_index).get_indexer(activity_df[by].values)
+    found = ranks >= 0
+    activity_sums = np.where(found, key_sums[np.maximum(ranks, 0)], 0)
+    activity_counts = np.where(found, key_counts[np.maximum(ranks, 0)], 0)
+
+    users, user_codes = np.unique(activity_df["user_id"].values, return_inverse=True)
+    sums = np.bincount(user_codes, weights=activity_sums, minlength=len(users))
+    user_counts = np.bincount(
+        user_codes, weights=activity_counts, minlength=len(users)
+    ).astype(np.int64)
+    return (users, sums, user_counts)
+
+
+def _sort_desc(query_df, column):
+    """Helper function to sort a result descending, breaking ties by user.
+
+    Parameters
+    ----------
+    query_df : Pandas DataFrame
+        The result, with the columns `user_id` and `column`.
+    column : str
+        The column to sort on.
+
+    Returns
+    -------
+    query_df : Pandas DataFrame
+        The sorted result.
+    """
+    return query_df.sort_values(
+        [column, "user_id"], ascending=[False, True], kind="stable"
+    ).reset_index(drop=True)